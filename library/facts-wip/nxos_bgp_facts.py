@@ -69,10 +69,22 @@ nxos_bgp_facts:
              "timer_bgp_keepalive": "60", "vrf": "ntc"}
 '''
 
+# netcfg exports its own parse() and ConfigLine, importing the module_utils
+# first lets the common code below take precedence over them
+from ansible.module_utils.basic import *
+from ansible.module_utils.urls import *
+from ansible.module_utils.shell import *
+from ansible.module_utils.netcfg import *
+from ansible.module_utils.nxos import *
+
 # COMMON CODE FOR MIGRATION
 
 import re
 import time
+import mmap
+import array
+import marshal
+import hashlib
 import collections
 import itertools
 import shlex
@@ -80,15 +92,127 @@ import itertools
 
 from ansible.module_utils.basic import BOOLEANS_TRUE, BOOLEANS_FALSE
 
+try:
+    from ansible.module_utils.nxos import get_module
+except ImportError:
+    # the nxos module_utils shipped with nxos_install_os build the module
+    # the 2.2 way, see get_network_module()
+    from ansible.module_utils.nxos import NetworkModule, NetworkError
+
+# the nxos module_utils shipped with nxos_install_os add the profile,
+# trace, metrics, cache_config and stage_config parameters, the fallbacks
+# below stand in for the functions the module calls whatever they are
+try:
+    from ansible.module_utils.nxos import HOOKS, run_hooks, instrument, run_phase
+except ImportError:
+    HOOKS = dict()
+
+    def run_hooks(event, **kwargs):
+        pass
+
+    def instrument(module):
+        pass
+
+    def run_phase(name, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+try:
+    from ansible.module_utils.nxos import read_cached_config, write_cached_config
+    from ansible.module_utils.nxos import invalidate_cached_config, cached_config_time
+    from ansible.module_utils.nxos import read_snapshot, write_snapshot
+except ImportError:
+    def cached_config_time(host, include_defaults=False):
+        return None
+
+    def read_cached_config(host, include_defaults=False, max_age=None):
+        return None
+
+    def write_cached_config(host, include_defaults, config, fetched=None):
+        pass
+
+    def invalidate_cached_config(host):
+        pass
+
+    def read_snapshot(digest):
+        return None
+
+    def write_snapshot(digest, data, limit=None):
+        pass
+
+try:
+    from ansible.module_utils.nxos import stage_config_lines, mark_save_pending
+except ImportError:
+    stage_config_lines = mark_save_pending = None
+
+try:
+    from ansible.module_utils.nxos import update_config
+except ImportError:
+    def update_config(module, config, candidate):
+        # the pushed lines are not modelled, the config is fetched again
+        module._config_cache.clear()
+
+try:
+    from ansible.module_utils.nxos import compile_pattern
+except ImportError:
+    PATTERNS = dict()
+
+    def compile_pattern(pattern, flags=re.M):
+        """Returns pattern compiled, it is compiled once per process
+        """
+        key = (pattern, flags)
+        regex = PATTERNS.get(key)
+        if regex is None:
+            regex = PATTERNS[key] = re.compile(pattern, flags)
+        return regex
+
 DEFAULT_COMMENT_TOKENS = ['#', '!']
 
+try:
+    from sys import intern
+except ImportError:
+    # intern() is a builtin on python 2
+    pass
+
 class ConfigLine(object):
+    """A line of config in a parsed tree
+
+    Only the direct parent is stored, parents is computed by walking up
+    the tree, and leaves share an empty tuple until a child is added, so
+    a parsed config takes memory in proportion to its number of lines.
+    """
+
+    __slots__ = ('text', 'raw', 'parent', '_children')
 
     def __init__(self, text):
         self.text = text
-        self.children = list()
-        self.parents = list()
         self.raw = None
+        self.parent = None
+        self._children = None
+
+    @property
+    def children(self):
+        if self._children is None:
+            return ()
+        return self._children
+
+    def add_child(self, child):
+        if self._children is None:
+            self._children = list()
+        self._children.append(child)
+
+    @property
+    def parents(self):
+        parents = list()
+        item = self.parent
+        while item is not None:
+            parents.append(item)
+            item = item.parent
+        parents.reverse()
+        return parents
+
+    @parents.setter
+    def parents(self, parents):
+        self.parent = parents[-1] if parents else None
 
     @property
     def line(self):
@@ -101,12 +225,21 @@ class ConfigLine(object):
         return self.raw
 
     def __eq__(self, other):
-        if self.text == other.text:
-            return self.parents == other.parents
+        ours, theirs = self, other
+        while ours is not None and theirs is not None:
+            if ours is theirs:
+                return True
+            if ours.text != theirs.text:
+                return False
+            ours, theirs = ours.parent, theirs.parent
+        return ours is None and theirs is None
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+def line_path(item):
+    return tuple([p.text for p in item.parents]) + (item.text,)
+
 def ignore_line(text, tokens=None):
     for item in (tokens or DEFAULT_COMMENT_TOKENS):
         if text.startswith(item):
@@ -117,64 +250,186 @@ def get_next(iterable):
     next_item = itertools.islice(next_item, 1, None)
     return itertools.izip_longest(item, next_item)
 
-def parse(lines, indent, comment_tokens=None):
-    toplevel = re.compile(r'\S')
-    childline = re.compile(r'^\s*(.+)$')
-
+# str.translate() arguments that delete the block delimiters, the
+# signature differs between byte and unicode strings
+if str is bytes:
+    DELIMITERS = (None, '{};')
+else:
+    DELIMITERS = (dict((ord(c), None) for c in '{};'),)
+
+def line_text(line):
+    """Returns the text of a config line without indentation and delimiters
+    """
+    text = line.strip()
+    if '{' in text or '}' in text or ';' in text:
+        text = text.translate(*DELIMITERS).strip()
+    return text
+
+def to_text(data):
+    """Decodes bytes read off a memory mapped file into a native string
+    """
+    if str is not bytes and isinstance(data, bytes):
+        return data.decode('utf-8')
+    return data
+
+def iter_lines(source):
+    """Yields the lines of a string, a memory map, a file-like object or
+    an iterable without building the whole list of lines first
+    """
+    if isinstance(source, mmap.mmap):
+        for line in iter(source.readline, b''):
+            yield to_text(line).rstrip('\n')
+    elif isinstance(source, basestring):
+        source = str(source)
+        start = 0
+        end = source.find('\n')
+        while end != -1:
+            yield source[start:end]
+            start = end + 1
+            end = source.find('\n', start)
+        yield source[start:]
+    else:
+        if hasattr(source, 'readline'):
+            source = iter(source.readline, '')
+        for line in source:
+            yield str(line).rstrip('\n')
+
+def iter_parse(lines, indent, comment_tokens=None):
+    """Parses config lines one at a time
+
+    Each ConfigLine is yielded as soon as it is linked to its parents, so
+    the tree built so far can be used while input is still arriving.
+    """
+    tokens = tuple(comment_tokens or DEFAULT_COMMENT_TOKENS)
     ancestors = list()
-    config = list()
 
-    for line in str(lines).split('\n'):
-        text = str(re.sub(r'([{};])', '', line)).strip()
+    for line in iter_lines(lines):
+        text = line_text(line)
 
-        cfg = ConfigLine(text)
-        cfg.raw = line
-
-        if not text or ignore_line(text, comment_tokens):
+        if not text or text.startswith(tokens):
             continue
 
+        # repeated lines such as 'no shutdown' share a single string
+        cfg = ConfigLine(intern(text))
+        cfg.raw = intern(line)
+
+        level = int((len(line) - len(line.lstrip())) / indent)
+
         # handle top level commands
-        if toplevel.match(line):
+        if not level:
             ancestors = [cfg]
 
         # handle sub level commands
         else:
-            match = childline.match(line)
-            line_indent = match.start(1)
-            level = int(line_indent / indent)
-            parent_level = level - 1
-
             cfg.parents = ancestors[:level]
 
-            if level > len(ancestors):
-                config.append(cfg)
-                continue
+            if level <= len(ancestors):
+                del ancestors[level:]
+                ancestors[-1].add_child(cfg)
+                ancestors.append(cfg)
 
-            for i in range(level, len(ancestors)):
-                ancestors.pop()
+        yield cfg
 
-            ancestors.append(cfg)
-            ancestors[parent_level].children.append(cfg)
+def parse(lines, indent, comment_tokens=None):
+    if 'phase' not in HOOKS:
+        return list(iter_parse(lines, indent, comment_tokens))
+    start = time.time()
+    items = list(iter_parse(lines, indent, comment_tokens))
+    run_hooks('phase', name='parse', start=start, seconds=time.time() - start,
+              lines=len(items))
+    return items
 
-        config.append(cfg)
 
-    return config
+# bumped whenever the layout of a snapshot changes
+SNAPSHOT_VERSION = 1
 
+# lines starting at the first column, each opens a top level section
+TOPLEVEL_RE = re.compile(r'^\S.*$', re.M)
+MAPPED_TOPLEVEL_RE = re.compile(br'^\S.*$', re.M)
 
 class CustomNetworkConfig(object):
+    """A parsed config
+
+    With lazy set, loading only indexes the top level lines and where
+    their sections start and end. A section is parsed the first time
+    get_object() and the lookups built on it ask for it, and the whole
+    config the first time items is used.
+    """
 
-    def __init__(self, indent=None, contents=None, device_os=None):
+    def __init__(self, indent=None, contents=None, device_os=None, lazy=False):
         self.indent = indent or 1
         self._config = list()
         self._device_os = device_os
+        self._lazy = lazy
 
         if contents:
             self.load(contents)
 
     @property
     def items(self):
+        if self._config is None:
+            config = list()
+            for index in range(len(self._spans)):
+                config.extend(self._parse_span(index))
+            self._config = config
+            self._text = self._spans = self._sections = None
         return self._config
 
+    def _index(self, contents):
+        if isinstance(contents, mmap.mmap):
+            # sections are decoded off the mapping when they are parsed
+            self._text = contents
+            pattern = MAPPED_TOPLEVEL_RE
+        else:
+            if hasattr(contents, 'read'):
+                contents = contents.read()
+            elif not isinstance(contents, basestring):
+                contents = '\n'.join(contents)
+            self._text = str(contents)
+            pattern = TOPLEVEL_RE
+        self._config = None
+
+        starts = list()
+        for match in pattern.finditer(self._text):
+            text = line_text(to_text(match.group()))
+            # a line left empty once its delimiters are gone starts nothing
+            if text and not ignore_line(text):
+                starts.append((match.start(), text))
+
+        # lines ahead of the first top level line go in a span of their own
+        self._spans = list()
+        if not starts or starts[0][0] > 0:
+            self._spans.append((None, 0, starts[0][0] if starts else len(self._text)))
+        for index, (start, text) in enumerate(starts):
+            try:
+                end = starts[index + 1][0]
+            except IndexError:
+                end = len(self._text)
+            self._spans.append((text, start, end))
+
+        self._sections = dict()
+        for index, (text, start, end) in enumerate(self._spans):
+            self._sections.setdefault(text, list()).append(index)
+        self._parsed = dict()
+
+    def _parse_span(self, index):
+        items = self._parsed.get(index)
+        if items is None:
+            text, start, end = self._spans[index]
+            items = parse(to_text(self._text[start:end]), indent=self.indent)
+            self._parsed[index] = items
+        return items
+
+    def _section_items(self, text):
+        """Returns the parsed lines of the sections under top level text
+        """
+        if self._config is not None:
+            return self._config
+        items = list()
+        for index in self._sections.get(None, []) + self._sections.get(text, []):
+            items.extend(self._parse_span(index))
+        return items
+
     @property
     def lines(self):
         lines = list()
@@ -186,27 +441,110 @@ class CustomNetworkConfig(object):
         return lines
 
     def __str__(self):
-        text = ''
+        # expanding each top level item in place, looking it up again by
+        # its text made this quadratic in the number of sections
+        blocks = list()
+        first = dict()
         for item in self.items:
-            if not item.parents:
-                expand = self.get_section(item.text)
-                text += '%s\n' % self.get_section(item.text)
-        return str(text).strip()
+            if item.parent is None:
+                # a repeated top level line prints the section of its first
+                # occurrence, as the lookup by text did
+                section = self.expand_section(first.setdefault(item.text, item))
+                if self._device_os == 'junos':
+                    blocks.append('%s' % self.to_lines(section))
+                else:
+                    blocks.append(self.to_block(section))
+        return '\n'.join(blocks).strip()
 
     def load(self, contents):
-        self._config = parse(contents, indent=self.indent)
+        if self._lazy:
+            self._index(contents)
+        else:
+            self._config = parse(contents, indent=self.indent)
+
+    def iter_load(self, contents):
+        """Loads contents while yielding each parsed line
+
+        The config can be searched for the lines parsed so far while the
+        rest of contents is still being read.
+        """
+        self._config = list()
+        for item in iter_parse(contents, indent=self.indent):
+            self._config.append(item)
+            yield item
 
     def load_from_file(self, filename):
-        self.load(open(filename).read())
+        """Loads a config file through a read only memory map
+
+        The lines are parsed straight off the mapping, the file is never
+        read into a single string. With lazy set the mapping is kept until
+        the whole config is parsed, and the section index holds offsets
+        into it, so only the sections looked up are ever decoded.
+        """
+        with open(filename, 'rb') as f:
+            try:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # an empty file cannot be mapped
+                self.load('')
+                return
+
+        if self._lazy:
+            self._index(mapping)
+        else:
+            try:
+                self._config = parse(mapping, indent=self.indent)
+            finally:
+                mapping.close()
+
+    def dump_snapshot(self):
+        """Returns the parsed config as a compact binary snapshot
+
+        The lines are stored in parallel arrays, the parent of each line
+        being the index of an earlier line, or -1 for the top level.
+        """
+        items = self.items
+        index = dict((id(item), i) for i, item in enumerate(items))
+        parents = array.array('i')
+        for item in items:
+            parents.append(index.get(id(item.parent), -1))
+        try:
+            parents = parents.tobytes()
+        except AttributeError:
+            # python 2
+            parents = parents.tostring()
+        texts = [item.text for item in items]
+        raws = [item.raw for item in items]
+        return marshal.dumps((SNAPSHOT_VERSION, self.indent, texts, raws, parents))
+
+    def load_snapshot(self, data):
+        """Loads a snapshot returned by dump_snapshot() instead of parsing
+        """
+        version, indent, texts, raws, parents = marshal.loads(data)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('unsupported snapshot version %s' % version)
+        links = array.array('i')
+        try:
+            links.frombytes(parents)
+        except AttributeError:
+            links.fromstring(parents)
+
+        config = list()
+        for index in range(len(texts)):
+            item = ConfigLine(texts[index])
+            item.raw = raws[index]
+            parent = links[index]
+            if parent >= 0:
+                item.parent = config[parent]
+                config[parent].add_child(item)
+            config.append(item)
+        self.indent = indent
+        self._config = config
 
     def get(self, path):
         if isinstance(path, basestring):
             path = [path]
-        for item in self._config:
-            if item.text == path[-1]:
-                parents = [p.text for p in item.parents]
-                if parents == path[:-1]:
-                    return item
+        return self.get_object(path)
 
     def search(self, regexp, path=None):
         regex = re.compile(r'^%s' % regexp, re.M)
@@ -275,14 +613,19 @@ class CustomNetworkConfig(object):
             raise ValueError('path does not exist in config')
         return self.expand_section(obj)
 
-    def expand_section(self, configobj, S=None):
+    def expand_section(self, configobj, S=None, seen=None):
+        # lines are equal when their paths are, so a set of the paths
+        # expanded skips repeated lines without scanning S for each child
         if S is None:
             S = list()
+        if seen is None:
+            seen = set([line_path(item) for item in S])
         S.append(configobj)
+        seen.add(line_path(configobj))
         for child in configobj.children:
-            if child in S:
+            if line_path(child) in seen:
                 continue
-            self.expand_section(child, S)
+            self.expand_section(child, S, seen)
         return S
 
     def flatten(self, data, obj=None):
@@ -294,7 +637,7 @@ class CustomNetworkConfig(object):
         return obj
 
     def get_object(self, path):
-        for item in self.items:
+        for item in self._section_items(path[0]):
             if item.text == path[-1]:
                 parents = [p.text for p in item.parents]
                 if parents == path[:-1]:
@@ -416,7 +759,7 @@ class CustomNetworkConfig(object):
                     obj.raw = p.rjust(len(p) + offset)
                     if ancestors:
                         obj.parents = list(ancestors)
-                        ancestors[-1].children.append(obj)
+                        ancestors[-1].add_child(obj)
                     self.items.append(obj)
                     ancestors.append(obj)
 
@@ -431,7 +774,7 @@ class CustomNetworkConfig(object):
                     item = ConfigLine(line)
                     item.raw = line.rjust(len(line) + offset)
                     item.parents = ancestors
-                    ancestors[-1].children.append(item)
+                    ancestors[-1].add_child(item)
                     self.items.append(item)
 
 
@@ -443,32 +786,310 @@ def argument_spec():
     )
 nxos_argument_spec = argument_spec()
 
-def get_config(module):
-    config = module.params['running_config']
-    if not config:
-        config = module.get_config()
-    return CustomNetworkConfig(indent=2, contents=config)
+def get_network_module(**kwargs):
+    try:
+        return get_module(**kwargs)
+    except NameError:
+        # connected on first use, a module given its running_config
+        # does not connect at all
+        return NetworkModule(connect_on_load=False, **kwargs)
+
+def legacy_module(module):
+    """Returns True for the module of 2.1, which sends commands itself
+    """
+    return hasattr(module, 'execute')
+
+def run_transport(module, method, *args, **kwargs):
+    """Runs a method of the transport of a 2.2 module
+
+    The transports raise NetworkError, the module is failed with its
+    details as the transports of 2.1 fail it.
+    """
+    try:
+        if not module.connected:
+            module.connect()
+        return getattr(module.connection, method)(*args, **kwargs)
+    except NetworkError:
+        exc = get_exception()
+        module.fail_json(**dict(exc.kwargs, msg=str(exc)))
+
+# the output the 2.2 transports are asked for, by NX-API command type
+COMMAND_TYPE_TO_OUTPUT = {
+    'cli_show': 'json',
+    'cli_show_ascii': 'text',
+    'cli_conf': 'config'
+}
+
+def execute_commands(module, commands, command_type='cli_show_ascii'):
+    """Returns the responses to commands, command_type is only used by nxapi
+    """
+    commands = to_list(commands)
+    if not legacy_module(module):
+        return run_transport(module, 'execute', commands,
+                             output=COMMAND_TYPE_TO_OUTPUT[command_type])
+    if module.params['transport'] == 'nxapi':
+        return module.execute(commands, command_type=command_type)
+    return module.execute(commands)
+
+def get_running_config(module, include_defaults):
+    if not legacy_module(module):
+        return run_transport(module, 'get_config', include_defaults=include_defaults)
+    # reads include_defaults from the module parameters
+    return module.get_config()
+
+def load_commands(module, commands):
+    if not legacy_module(module):
+        # checkpointed, and sent in a single request over nxapi
+        return run_transport(module, 'load_config', commands)
+    return module.configure(commands)
+
+def save_running_config(module):
+    if not legacy_module(module):
+        # left to nxos_commit with defer_save
+        return run_transport(module, 'save_config')
+    return module.execute(['copy running-config startup-config'])
+
+def get_config(module, parents=None):
+    """Returns the parsed running config
+
+    When parents is given only the part of the config that contains it
+    may be retrieved from the device, see get_config_scope().
+    """
+    # the parsed config is kept for the rest of the module run, keyed
+    # on the include_defaults setting and the scope it was retrieved with
+    include_defaults = module.params.get('include_defaults')
+    scope = get_config_scope(parents)
+    cache = getattr(module, '_config_cache', None)
+    if cache is None:
+        cache = module._config_cache = dict()
+
+    key = (include_defaults, scope)
+    if key not in cache:
+        config = module.params['running_config']
+        if not config:
+            config = run_phase('fetch_config', fetch_config, module,
+                               include_defaults, scope)
+        cache[key] = load_parsed_config(module, config)
+    return cache[key]
+
+def snapshot_digest(config, indent=2):
+    """Returns the key of the parsed snapshot of config
+    """
+    if not isinstance(config, bytes):
+        config = config.encode('utf-8')
+    prefix = ('%s:%s:' % (SNAPSHOT_VERSION, indent)).encode('ascii')
+    return hashlib.sha1(prefix + config).hexdigest()
+
+def load_parsed_config(module, config):
+    """Parses config, or reloads its snapshot when cache_config is set
+    """
+    if not module.params.get('cache_config'):
+        return CustomNetworkConfig(indent=2, contents=config, lazy=True)
+
+    digest = snapshot_digest(config)
+    netcfg = CustomNetworkConfig(indent=2)
+    data = read_snapshot(digest)
+    if data:
+        try:
+            run_phase('load_snapshot', netcfg.load_snapshot, data)
+            return netcfg
+        except (ValueError, TypeError, EOFError):
+            # written by another version, parse it again below
+            pass
+
+    netcfg.load(config)
+    write_snapshot(digest, netcfg.dump_snapshot())
+    return netcfg
+
+def get_config_scope(parents):
+    """Maps a parent path to the narrowest running-config filter holding it
+    """
+    if not parents:
+        return None
+    if not isinstance(parents, list):
+        parents = [parents]
+
+    top = parents[0]
+    if top.startswith('interface '):
+        return top
+    elif top.startswith('router bgp '):
+        return 'bgp'
+    elif top.startswith('router ospf '):
+        return 'ospf'
+    elif top == 'evpn':
+        return '| section ^evpn'
+    return None
+
+def get_config_command(include_defaults, scope=None):
+    cmd = 'show running-config'
+    if scope and not scope.startswith('|'):
+        cmd += ' %s' % scope
+    if include_defaults:
+        cmd += ' all'
+    if scope and scope.startswith('|'):
+        cmd += ' %s' % scope
+    return cmd
+
+class ScopeRejected(Exception):
+    pass
+
+def fetch_scoped_config(module, include_defaults, scope):
+    """Returns the part of the running config that scope selects
+
+    The command is sent with execute(), module.config would retrieve the
+    full config first. The transports fail the module when the device
+    rejects a command, such a failure raises ScopeRejected instead.
+    """
+    cmd = get_config_command(include_defaults, scope)
+    fail_json = module.fail_json
+
+    def reject(**kwargs):
+        # a rejected command reports its input, a failed connection does not
+        if 'input' in kwargs or 'commands' in kwargs:
+            raise ScopeRejected(kwargs.get('msg'))
+        fail_json(**kwargs)
+
+    module.fail_json = reject
+    try:
+        return execute_commands(module, [cmd])[0]
+    finally:
+        module.fail_json = fail_json
+
+def fetch_config(module, include_defaults, scope=None):
+    """Returns the running config from the host cache or the device
+
+    The host cache only sees the changes pushed by the modules that use
+    it, a change made elsewhere shows once it expires, see
+    ANSIBLE_NXOS_CONFIG_CACHE_MAX_AGE.
+    """
+    host = module.params['host']
+    if module.params.get('cache_config'):
+        config = read_cached_config(host, include_defaults)
+        if config:
+            return config
+
+    if scope:
+        try:
+            return fetch_scoped_config(module, include_defaults, scope)
+        except ScopeRejected:
+            # the filter is not supported by every release, fall
+            # back to retrieving the full config
+            pass
+
+    config = get_running_config(module, include_defaults)
+
+    if module.params.get('cache_config'):
+        write_cached_config(host, include_defaults, config)
+    return config
 
 def load_config(module, candidate):
     config = get_config(module)
 
-    commands = candidate.difference(config)
-    commands = [str(c).strip() for c in commands]
+    updates = candidate.difference(config)
+    commands = [str(c).strip() for c in updates]
 
     save_config = module.params['save_config']
 
     result = dict(changed=False)
 
     if commands:
-        if not module.check_mode:
-            module.configure(commands)
+        if module.params.get('stage_config'):
+            # nxos_commit applies the changes staged by all modules
+            # in a single transaction, check mode only reports them
+            if not module.check_mode:
+                stage_config_lines(module.params['host'], [str(c) for c in updates])
+                if save_config:
+                    mark_save_pending(module.params['host'])
+        elif not module.check_mode:
+            load_commands(module, commands)
+            update_config(module, config, candidate)
             if save_config:
-                module.config.save_config()
+                save_running_config(module)
 
         result['changed'] = True
         result['updates'] = commands
 
     return result
+
+# the patterns of the keymaps are compiled once, on first use, and
+# their matches start with the command so ScannedConfig can anchor them
+def bool_pattern(command):
+    """Matches command alone on a line, such as a shutdown"""
+    return compile_pattern(r'(?<=\s){0}\s*$'.format(command))
+
+def value_pattern(command):
+    """Captures the value given to command"""
+    return compile_pattern(r'(?:{0}\s)(?P<value>.*)$'.format(command))
+
+class KeywordScanner(object):
+    """Finds where any of a set of keywords occur in a single pass
+
+    The keywords are tried as one alternation, the longest first, so the
+    scan only stops where a keyword starts, and the keywords that are a
+    prefix of the one found start there too.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = frozenset([k for k in keywords if k])
+        ordered = sorted(self.keywords, key=len, reverse=True)
+        self.pattern = '|'.join([re.escape(k) for k in ordered])
+        self.prefixes = dict([(k, [p for p in ordered if k.startswith(p)])
+                              for k in ordered])
+
+    def scan(self, text):
+        """Returns the offsets of the keywords found in text, by keyword"""
+        offsets = dict()
+        if not self.keywords:
+            return offsets
+        search = compile_pattern(self.pattern, 0).search
+        match = search(text)
+        while match:
+            start = match.start()
+            for keyword in self.prefixes[match.group()]:
+                offsets.setdefault(keyword, []).append(start)
+            match = search(text, start + 1)
+        return offsets
+
+class ScannedConfig(object):
+    """A config and the offsets of the keywords of a scanner in it
+
+    Membership tests and searches for the keywords are answered from
+    the offsets, instead of scanning the config once per keyword.
+    """
+
+    def __init__(self, text, scanner):
+        self.text = text
+        self.keywords = scanner.keywords
+        self.offsets = scanner.scan(text)
+
+    def __str__(self):
+        return self.text
+
+    def __contains__(self, keyword):
+        if keyword in self.keywords:
+            return keyword in self.offsets
+        return keyword in self.text
+
+    def search(self, pattern, keyword):
+        """Returns the match pattern.search() would, for a pattern whose
+        matches start with keyword
+        """
+        if keyword not in self.keywords:
+            return pattern.search(self.text)
+        for offset in self.offsets.get(keyword, ()):
+            match = pattern.match(self.text, offset)
+            if match:
+                return match
+        return None
+
+    def matches(self, pattern, keyword):
+        """Returns the matches of pattern at every offset of keyword"""
+        matches = list()
+        for offset in self.offsets.get(keyword, ()):
+            match = pattern.match(self.text, offset)
+            if match:
+                matches.append(match)
+        return matches
 # END OF COMMON CODE
 
 
@@ -589,6 +1210,8 @@ PARAM_TO_COMMAND_KEYMAP = {
     'timer_bgp_keepalive': 'timer bpg',
     'vrf': 'vrf'
 }
+# the custom values look up timers bgp as well
+SCANNER = KeywordScanner(list(PARAM_TO_COMMAND_KEYMAP.values()) + ['timers bgp'])
 
 
 def invoke(name, *args, **kwargs):
@@ -599,37 +1222,37 @@ def invoke(name, *args, **kwargs):
 
 def get_custom_value(config, arg):
     if arg.startswith('event_history'):
-        REGEX_SIZE = re.compile(r'(?:{0} size\s)(?P<value>.*)$'.format(PARAM_TO_COMMAND_KEYMAP[arg]), re.M)
-        REGEX = re.compile(r'\s+{0}\s*$'.format(PARAM_TO_COMMAND_KEYMAP[arg]), re.M)
+        REGEX_SIZE = compile_pattern(r'(?:{0} size\s)(?P<value>.*)$'.format(PARAM_TO_COMMAND_KEYMAP[arg]))
+        REGEX = bool_pattern(PARAM_TO_COMMAND_KEYMAP[arg])
         value = False
 
         if 'no {0}'.format(PARAM_TO_COMMAND_KEYMAP[arg]) in config:
             pass
         elif PARAM_TO_COMMAND_KEYMAP[arg] in config:
             try:
-                value = REGEX_SIZE.search(config).group('value')
+                value = config.search(REGEX_SIZE, PARAM_TO_COMMAND_KEYMAP[arg]).group('value')
             except AttributeError:
-                if REGEX.search(config):
+                if config.search(REGEX, PARAM_TO_COMMAND_KEYMAP[arg]):
                     value = True
 
     elif arg == 'confederation_peers':
-        REGEX = re.compile(r'(?:confederation peers\s)(?P<value>.*)$', re.M)
+        REGEX = compile_pattern(r'(?:confederation peers\s)(?P<value>.*)$')
         value = ''
         if 'confederation peers' in config:
-            value = REGEX.search(config).group('value').split()
+            value = config.search(REGEX, 'confederation peers').group('value').split()
 
     elif arg == 'timer_bgp_keepalive':
-        REGEX = re.compile(r'(?:timers bgp\s)(?P<value>.*)$', re.M)
+        REGEX = compile_pattern(r'(?:timers bgp\s)(?P<value>.*)$')
         value = ''
         if 'timers bgp' in config:
-            parsed = REGEX.search(config).group('value').split()
+            parsed = config.search(REGEX, 'timers bgp').group('value').split()
             value = parsed[0]
 
     elif arg == 'timer_bgp_hold':
-        REGEX = re.compile(r'(?:timers bgp\s)(?P<value>.*)$', re.M)
+        REGEX = compile_pattern(r'(?:timers bgp\s)(?P<value>.*)$')
         value = ''
         if 'timers bgp' in config:
-            parsed = REGEX.search(config).group('value').split()
+            parsed = config.search(REGEX, 'timers bgp').group('value').split()
             if len(parsed) == 2:
                 value = parsed[1]
 
@@ -648,20 +1271,20 @@ def get_value(arg, config):
     ]
 
     if arg in BOOL_PARAMS:
-        REGEX = re.compile(r'\s+{0}\s*$'.format(PARAM_TO_COMMAND_KEYMAP[arg]), re.M)
+        REGEX = bool_pattern(PARAM_TO_COMMAND_KEYMAP[arg])
         value = False
         try:
-            if REGEX.search(config):
+            if config.search(REGEX, PARAM_TO_COMMAND_KEYMAP[arg]):
                 value = True
         except TypeError:
             value = False
     elif arg in custom:
         value = get_custom_value(config, arg)
     else:
-        REGEX = re.compile(r'(?:{0}\s)(?P<value>.*)$'.format(PARAM_TO_COMMAND_KEYMAP[arg]), re.M)
+        REGEX = value_pattern(PARAM_TO_COMMAND_KEYMAP[arg])
         value = ''
         if PARAM_TO_COMMAND_KEYMAP[arg] in config:
-            value = REGEX.search(config).group('value')
+            value = config.search(REGEX, PARAM_TO_COMMAND_KEYMAP[arg]).group('value')
     return value
 
 
@@ -671,7 +1294,7 @@ def get_bgp_facts(module):
 
     try:
         asn_regex = '.*router\sbgp\s(?P<existing_asn>\d+).*'
-        match_asn = re.match(asn_regex, str(netcfg), re.DOTALL)
+        match_asn = compile_pattern(asn_regex, re.DOTALL).match(str(netcfg))
         existing_asn_group = match_asn.groupdict()
         existing_asn = existing_asn_group['existing_asn']
     except AttributeError:
@@ -687,10 +1310,9 @@ def get_bgp_facts(module):
         config = netcfg.get_section(parents)
 
         if config:
-            # remove the asn
-            ARGS.pop(0)
-
-            for arg in ARGS:
+            config = ScannedConfig(config, SCANNER)
+            # the asn is the one matched above
+            for arg in ARGS[1:]:
                 if module.params['vrf'] != 'default':
                     if arg not in GLOBAL_PARAMS:
                         existing[arg] = get_value(arg, config)
@@ -711,20 +1333,15 @@ def main():
             include_defaults=dict(default=True)
     )
     argument_spec.update(nxos_argument_spec)
-    module = get_module(argument_spec=argument_spec,
-                        supports_check_mode=True)
+    module = get_network_module(argument_spec=argument_spec,
+                                supports_check_mode=True)
+    instrument(module)
 
     result = dict(changed=False)
-    bgp_facts = dict(nxos_bgp_facts=invoke('get_bgp_facts', module))
+    bgp_facts = dict(nxos_bgp_facts=run_phase('extract', invoke, 'get_bgp_facts', module))
 
     module.exit_json(ansible_facts=bgp_facts)
 
 
-
-from ansible.module_utils.basic import *
-from ansible.module_utils.urls import *
-from ansible.module_utils.shell import *
-from ansible.module_utils.netcfg import *
-from ansible.module_utils.nxos import *
 if __name__ == '__main__':
     main()
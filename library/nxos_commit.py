@@ -0,0 +1,155 @@
+#!/usr/bin/python
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+DOCUMENTATION = '''
+---
+module: nxos_commit
+short_description: Perform the deferred work queued by other NX-OS modules.
+description:
+    - Modules run with C(stage_config=true) do not push their changes,
+      they queue them for the host instead. This module merges the queued
+      changes of all modules, drops the repeated lines and applies the
+      result in a single checkpointed transaction.
+    - Modules run with C(defer_save=true) do not copy the running-config
+      to the startup-config after their change, they mark the host as
+      needing a save instead. This module performs that save once per host,
+      no matter how many modules changed it, and does nothing when no
+      module did.
+notes:
+    - Run it as the last task of the play, or from a handler notified by
+      the configuration tasks.
+    - The pending state is kept on the control node under
+      C(~/.ansible/nxos), or the directory named by the
+      C(ANSIBLE_NXOS_STATE_DIR) environment variable.
+    - Changes are queued for the ansible-playbook run that staged them, as
+      told by its process group. Set the C(ANSIBLE_NXOS_STAGE_ID)
+      environment variable to a value of the run when runs share a process
+      group, such as runs started one after the other by a script.
+    - The queued changes are only cleared once the device is connected, and
+      queued again when applying them fails.
+    - Modules run in check mode do not queue their changes. In check mode,
+      the module reports the changes queued by the run and whether a save
+      is pending, and leaves them queued.
+extends_documentation_fragment: nxos
+version_added: 2.2
+'''
+
+EXAMPLES = '''
+- nxos_bgp:
+    asn: 65535
+    router_id: 1.1.1.1
+    save: true
+    defer_save: true
+    provider: "{{ nxos_provider }}"
+
+- nxos_ospf:
+    ospf: 1
+    save: true
+    defer_save: true
+    provider: "{{ nxos_provider }}"
+
+# a single copy running-config startup-config for both changes
+- nxos_commit:
+    provider: "{{ nxos_provider }}"
+
+# queue the changes of several modules and apply them at once
+- nxos_interface:
+    interface: Ethernet1/1
+    mode: layer3
+    stage_config: true
+    provider: "{{ nxos_provider }}"
+
+- nxos_bgp_neighbor:
+    asn: 65535
+    neighbor: 172.16.100.2
+    remote_as: 65512
+    stage_config: true
+    provider: "{{ nxos_provider }}"
+
+- nxos_commit:
+    provider: "{{ nxos_provider }}"
+'''
+
+RETURN = '''
+updates:
+    description: The merged commands applied to the device.
+    returned: always
+    type: list
+    sample: ["interface Ethernet1/1", "no switchport", "router bgp 65535",
+             "neighbor 172.16.100.2", "remote-as 65512"]
+saved:
+    description: Whether the running-config was copied to the startup-config.
+    returned: always
+    type: boolean
+    sample: true
+'''
+
+from ansible.module_utils.basic import get_exception
+from ansible.module_utils.nxos import NetworkModule, NetworkError
+from ansible.module_utils.nxos import save_pending, merge_config_lines
+from ansible.module_utils.nxos import read_staged_config, pop_staged_config
+from ansible.module_utils.nxos import stage_config_lines
+from ansible.module_utils.nxos import invalidate_cached_config
+
+
+def apply_staged_config(module, blocks):
+    updates = merge_config_lines(blocks)
+    if updates and not module.check_mode:
+        try:
+            module.connection.load_config(updates)
+        except NetworkError:
+            # keep the changes queued so that the next run can retry them
+            for block in blocks:
+                stage_config_lines(module.params['host'], block)
+            raise
+        # the merged change was never applied to a cached running config
+        invalidate_cached_config(module.params['host'])
+    return updates
+
+
+def main():
+    argument_spec = dict()
+    module = NetworkModule(argument_spec=argument_spec,
+                           supports_check_mode=True,
+                           connect_on_load=False)
+
+    host = module.params['host']
+    blocks = read_staged_config(host)
+    saved = save_pending(host)
+    updates = list()
+
+    # nothing changed on this host, so there is no need to connect
+    if blocks or saved:
+        try:
+            if not module.check_mode:
+                module.connect()
+                # a failed connect leaves the changes queued
+                blocks = pop_staged_config(host)
+            updates = apply_staged_config(module, blocks)
+            if saved and not module.check_mode:
+                saved = module.connection.flush_save_config()
+        except NetworkError:
+            exc = get_exception()
+            module.fail_json(msg=str(exc))
+
+    changed = bool(updates) or saved
+    module.exit_json(changed=changed, updates=updates, saved=saved)
+
+
+if __name__ == '__main__':
+    main()
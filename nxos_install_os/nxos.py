@@ -17,11 +17,17 @@
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
 import re
+import sys
+import gzip
 import time
+import fcntl
+import atexit
+import socket
 import collections
 
-from ansible.module_utils.basic import json, json_dict_bytes_to_unicode
+from ansible.module_utils.basic import json, json_dict_bytes_to_unicode, get_exception
 from ansible.module_utils.network import ModuleStub, NetworkError, NetworkModule
 from ansible.module_utils.network import add_argument, register_transport, to_list
 from ansible.module_utils.shell import CliBase
@@ -29,20 +35,1071 @@ from ansible.module_utils.urls import fetch_url, url_argument_spec
 
 add_argument('use_ssl', dict(default=False, type='bool'))
 add_argument('validate_certs', dict(default=True, type='bool'))
+add_argument('pipeline_window', dict(default=1, type='int'))
+add_argument('defer_save', dict(default=False, type='bool'))
+add_argument('stage_config', dict(default=False, type='bool'))
+add_argument('cache_config', dict(default=False, type='bool'))
+add_argument('cassette', dict())
+add_argument('replay_latency', dict(default=False, type='bool'))
+add_argument('profile', dict(default=False, type='bool'))
+add_argument('trace', dict())
+add_argument('metrics', dict())
+
+# callables run with the event name and its arguments when the transports
+# and the parser reach these events:
+#   request: one or more round trips to the device, with transport, host,
+#            commands, requests, sent and received bytes and error
+#   phase: a step of the module run such as connect, parse or extract,
+#          with name, host and for parse the number of lines
+#   call: a call to execute() or get_config() of a transport, with name,
+#         transport, host, commands, the size of the response and error,
+#         the calls it makes itself are not reported apart
+#   regex: the compile or a match of a pattern of compile_pattern(), with
+#          op set to compile or match
+# every event carries the time it started at and the seconds it took
+HOOKS = dict()
+
+
+def add_hook(event, func):
+    HOOKS.setdefault(event, list()).append(func)
+
+
+def remove_hook(event, func):
+    funcs = HOOKS.get(event) or list()
+    if func in funcs:
+        funcs.remove(func)
+    if not funcs:
+        HOOKS.pop(event, None)
+
+
+def run_hooks(event, **kwargs):
+    for func in HOOKS.get(event) or ():
+        func(event, **kwargs)
+
+
+def run_phase(name, func, *args, **kwargs):
+    """Runs func as the phase name of the module run
+    """
+    if 'phase' not in HOOKS:
+        return func(*args, **kwargs)
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        run_hooks('phase', name=name, start=start, seconds=time.time() - start)
+
+
+# compiled patterns shared by every module of the process, keyed on the
+# pattern and its flags
+PATTERNS = dict()
+
+
+def compile_pattern(pattern, flags=re.M):
+    """Returns pattern compiled, it is compiled once per process
+
+    Unlike the cache of the re module, which python 2 empties once it
+    holds 100 patterns, this one keeps every pattern of the keymaps.
+    """
+    key = (pattern, flags)
+    regex = PATTERNS.get(key)
+    if regex is None:
+        start = time.time()
+        regex = PATTERNS[key] = re.compile(pattern, flags)
+        if 'regex' in HOOKS:
+            run_hooks('regex', op='compile', start=start, seconds=time.time() - start)
+    if 'regex' in HOOKS:
+        return TimedPattern(regex)
+    return regex
+
+
+class TimedPattern(object):
+    """A compiled pattern reporting the time of its matches as regex events
+    """
+
+    __slots__ = ('regex',)
+
+    def __init__(self, regex):
+        self.regex = regex
+
+    def _timed(self, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            run_hooks('regex', op='match', start=start, seconds=time.time() - start)
+
+    def search(self, *args):
+        return self._timed(self.regex.search, *args)
+
+    def match(self, *args):
+        return self._timed(self.regex.match, *args)
+
+    def findall(self, *args):
+        return self._timed(self.regex.findall, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.regex, name)
+
+
+class Profile(object):
+    """Adds up the events of a module run into the _perf result returned
+    when the profile parameter is set
+
+    Phases nest, such as the parse of a section looked up while extracting,
+    and the time of a phase excludes that of the phases run within it.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = dict()
+        self.requests = 0
+        self.request_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors = 0
+        self.lines = 0
+        self.regex = dict(compile_seconds=0.0, match_seconds=0.0, compiled=0, matches=0)
+        # phases not yet claimed by an enclosing one, as (start, seconds)
+        self._finished = list()
+
+    def __call__(self, event, **kwargs):
+        getattr(self, 'on_%s' % event)(**kwargs)
+
+    def on_request(self, requests=1, sent=0, received=0, seconds=0, error=None, **kwargs):
+        self.requests += requests
+        self.request_seconds += seconds
+        self.bytes_sent += sent
+        self.bytes_received += received
+        if error:
+            self.errors += 1
+
+    def on_phase(self, name, start, seconds, lines=None, **kwargs):
+        inner = [p for p in self._finished if p[0] >= start]
+        self._finished = [p for p in self._finished if p[0] < start]
+        self._finished.append((start, seconds))
+        own = max(seconds - sum([p[1] for p in inner]), 0)
+        self.phases[name] = self.phases.get(name, 0) + own
+        if lines:
+            self.lines += lines
+
+    def on_regex(self, op, seconds, **kwargs):
+        # the time of the regexes is part of that of the phases they run in
+        if op == 'compile':
+            self.regex['compile_seconds'] += seconds
+            self.regex['compiled'] += 1
+        else:
+            self.regex['match_seconds'] += seconds
+            self.regex['matches'] += 1
+
+    def install(self):
+        for event in ('request', 'phase', 'regex'):
+            add_hook(event, self)
+
+    def uninstall(self):
+        for event in ('request', 'phase', 'regex'):
+            remove_hook(event, self)
+
+    def result(self):
+        return dict(seconds=round(time.time() - self.start, 6),
+                    phases=dict([(k, round(v, 6)) for k, v in self.phases.items()]),
+                    requests=self.requests,
+                    request_seconds=round(self.request_seconds, 6),
+                    bytes_sent=self.bytes_sent,
+                    bytes_received=self.bytes_received,
+                    errors=self.errors,
+                    lines=self.lines,
+                    regex=dict(compile_seconds=round(self.regex['compile_seconds'], 6),
+                               match_seconds=round(self.regex['match_seconds'], 6),
+                               compiled=self.regex['compiled'],
+                               matches=self.regex['matches']))
+
+
+def start_profile(module):
+    """Starts profiling the module run when its profile parameter is set
+
+    The result of the module gets a _perf dict with the wall time of each
+    phase, the requests made to the device and the bytes they carried, the
+    number of config lines parsed, and the time spent compiling and
+    matching the patterns of compile_pattern().
+    """
+    if not module.params.get('profile'):
+        return None
+
+    profile = Profile()
+    profile.install()
+
+    def add_perf(result, failed):
+        profile.uninstall()
+        result['_perf'] = profile.result()
+
+    on_module_exit(module, add_perf)
+    return profile
+
+
+# trace file written by every module run, unless set by its trace parameter
+TRACE_FILE = os.environ.get('ANSIBLE_NXOS_TRACE')
+
+
+class Tracer(object):
+    """Writes the events of a module run as spans to a trace file
+
+    Files ending in .json get Chrome trace events, which chrome://tracing
+    and Perfetto open, any other file gets one JSON object per span. The
+    spans are kept in memory and appended in a single write once the run
+    is over, so that the runs of a play can share the file.
+    """
+
+    EVENTS = ('request', 'phase', 'call')
+
+    def __init__(self, path, process=None):
+        self.path = path
+        self.process = process or module_name()
+        self.spans = list()
+
+    def __call__(self, event, **kwargs):
+        self.spans.append((event, kwargs))
+
+    def install(self):
+        for event in self.EVENTS:
+            add_hook(event, self)
+
+    def uninstall(self):
+        for event in self.EVENTS:
+            remove_hook(event, self)
+
+    def span(self, event, kwargs):
+        args = dict(kwargs)
+        start = args.pop('start')
+        seconds = args.pop('seconds')
+        if event == 'request':
+            name = (args.get('commands') or [event])[0]
+        else:
+            name = args.pop('name')
+        return name, start, seconds, args
+
+    def flush(self):
+        spans, self.spans = self.spans, list()
+        if not spans:
+            return
+
+        pid = os.getpid()
+        lines = list()
+        if self.path.endswith('.json'):
+            self._start_array()
+            lines.append(dict(name='process_name', ph='M', pid=pid, tid=0,
+                              args=dict(name=self.process)))
+            for event, kwargs in spans:
+                name, start, seconds, args = self.span(event, kwargs)
+                lines.append(dict(name=name, cat=event, ph='X', pid=pid, tid=0,
+                                  ts=int(start * 1000000), dur=int(seconds * 1000000),
+                                  args=args))
+            data = ''.join(['%s,\n' % json.dumps(l) for l in lines])
+        else:
+            for event, kwargs in spans:
+                name, start, seconds, args = self.span(event, kwargs)
+                args.update(event=event, name=name, start=start, seconds=seconds,
+                            pid=pid, process=self.process)
+                lines.append(args)
+            data = ''.join(['%s\n' % json.dumps(l) for l in lines])
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 420)
+        try:
+            os.write(fd, data.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    def _start_array(self):
+        # the trace viewers take an array left open, its opening bracket is
+        # linked in with the file so that no span can be written ahead of it
+        if os.path.exists(self.path):
+            return
+        tmp = '%s.%s' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('[\n')
+        try:
+            os.link(tmp, self.path)
+        except OSError:
+            pass
+        finally:
+            os.remove(tmp)
+
+
+def start_trace(module):
+    """Starts tracing the module run to the file of its trace parameter,
+    or of ANSIBLE_NXOS_TRACE
+    """
+    path = module.params.get('trace') or TRACE_FILE
+    if not path:
+        return None
+
+    tracer = Tracer(path, '%s %s' % (module_name(), module.params.get('host') or ''))
+    tracer.install()
+    # modules leaving through sys.exit() rather than exit_json() included
+    atexit.register(tracer.flush)
+
+    def flush(result, failed):
+        tracer.uninstall()
+        tracer.flush()
+
+    on_module_exit(module, flush)
+    return tracer
+
+
+# textfile collector file updated by every module run, unless set by its
+# metrics parameter
+METRICS_FILE = os.environ.get('ANSIBLE_NXOS_METRICS')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class MetricsSink(object):
+    """Adds the events of a module run to the histograms and counters of
+    a Prometheus textfile collector file
+
+    The runs of a play update the same file, each one under a lock on a
+    file next to it, and the file is replaced by rename so that the
+    collector never reads it half written.
+    """
+
+    # name, type, help, buckets
+    METRICS = [
+        ('nxos_request_seconds', 'histogram',
+         'Seconds taken by round trips to the device', LATENCY_BUCKETS),
+        ('nxos_request_bytes', 'histogram',
+         'Bytes carried by round trips to the device', SIZE_BUCKETS),
+        ('nxos_request_errors_total', 'counter',
+         'Round trips to the device that failed', None),
+        ('nxos_parse_seconds', 'histogram',
+         'Seconds spent parsing the config in a module run', LATENCY_BUCKETS),
+        ('nxos_module_seconds', 'histogram',
+         'Seconds taken by module runs', LATENCY_BUCKETS),
+        ('nxos_module_runs_total', 'counter',
+         'Module runs by status', None)
+    ]
+
+    SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?\s+(\S+)')
+
+    def __init__(self, path, module, host):
+        self.path = path
+        self.labels = (('host', host), ('module', module))
+        self.start = time.time()
+        self.parse_seconds = None
+        # metric name, extra labels and value, in the order observed
+        self.observations = list()
+        self.counts = list()
+
+    def __call__(self, event, **kwargs):
+        if event == 'request':
+            transport = (('transport', kwargs.get('transport') or ''),)
+            self.observations.append(('nxos_request_seconds', transport, kwargs['seconds']))
+            for direction in ('sent', 'received'):
+                self.observations.append(('nxos_request_bytes', transport +
+                                          (('direction', direction),), kwargs.get(direction) or 0))
+            self.counts.append(('nxos_request_errors_total', transport,
+                                kwargs.get('error') and 1 or 0))
+        elif event == 'phase' and kwargs.get('name') == 'parse':
+            self.parse_seconds = (self.parse_seconds or 0) + kwargs['seconds']
+
+    def install(self):
+        for event in ('request', 'phase'):
+            add_hook(event, self)
+
+    def uninstall(self):
+        for event in ('request', 'phase'):
+            remove_hook(event, self)
+
+    def flush(self, failed=False):
+        self.observations.append(('nxos_module_seconds', (), time.time() - self.start))
+        if self.parse_seconds is not None:
+            self.observations.append(('nxos_parse_seconds', (), self.parse_seconds))
+        self.counts.append(('nxos_module_runs_total',
+                            (('status', failed and 'failed' or 'ok'),), 1))
+
+        lock = open('%s.lock' % self.path, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            samples = self.read()
+            self.update(samples)
+            self.write(samples)
+        finally:
+            lock.close()
+        self.observations = list()
+        self.counts = list()
+
+    def read(self):
+        samples = collections.OrderedDict()
+        try:
+            f = open(self.path)
+        except IOError:
+            return samples
+        try:
+            for line in f:
+                match = self.SAMPLE_RE.match(line)
+                if match and not line.startswith('#'):
+                    name, labels, value = match.groups()
+                    samples[(name, labels or '')] = float(value)
+        finally:
+            f.close()
+        return samples
+
+    def update(self, samples):
+        buckets = dict([(m[0], m[3]) for m in self.METRICS])
+
+        def add(name, labels, value):
+            key = (name, self.format_labels(labels))
+            samples[key] = samples.get(key, 0) + value
+
+        for name, labels, value in self.observations:
+            labels = self.labels + labels
+            for bound in buckets[name]:
+                add('%s_bucket' % name, labels + (('le', str(bound)),), value <= bound and 1 or 0)
+            add('%s_bucket' % name, labels + (('le', '+Inf'),), 1)
+            add('%s_sum' % name, labels, value)
+            add('%s_count' % name, labels, 1)
+
+        for name, labels, value in self.counts:
+            add(name, self.labels + labels, value)
+
+    def write(self, samples):
+        lines = list()
+        for name, kind, text, buckets in self.METRICS:
+            names = [name]
+            if kind == 'histogram':
+                names = ['%s_bucket' % name, '%s_sum' % name, '%s_count' % name]
+            family = [k for k in samples if k[0] in names]
+            if not family:
+                continue
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for key in family:
+                lines.append('%s%s %s' % (key[0], key[1], self.format_value(samples.pop(key))))
+
+        # samples of metrics this version does not know are kept as they are
+        for key, value in samples.items():
+            lines.append('%s%s %s' % (key[0], key[1], self.format_value(value)))
+
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp, self.path)
+
+    def format_labels(self, labels):
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{%s}' % ','.join(['%s="%s"' % (k, escape(v)) for k, v in labels])
+
+    def format_value(self, value):
+        if value == int(value):
+            return str(int(value))
+        return repr(value)
+
+
+def start_metrics(module):
+    """Starts adding the module run to the textfile collector file of its
+    metrics parameter, or of ANSIBLE_NXOS_METRICS
+    """
+    path = module.params.get('metrics') or METRICS_FILE
+    if not path:
+        return None
+
+    sink = MetricsSink(path, module_name(), module.params.get('host') or '')
+    sink.install()
+
+    def flush(result, failed):
+        sink.uninstall()
+        sink.flush(failed)
+
+    on_module_exit(module, flush)
+    return sink
+
+
+def instrument(module):
+    """Starts the profiling, tracing and metrics the module run asks for
+    """
+    start_profile(module)
+    start_trace(module)
+    start_metrics(module)
+
+
+def on_module_exit(module, func):
+    """Has func called with the result of the module, and whether it
+    failed, before the result is returned
+    """
+    def before(exit, failed):
+        def wrapper(**kwargs):
+            func(kwargs, failed)
+            exit(**kwargs)
+        return wrapper
+
+    module.exit_json = before(module.exit_json, False)
+    module.fail_json = before(module.fail_json, True)
+
+
+def module_name():
+    # modules run as ansible_module_<name>.py
+    name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    if name.startswith('ansible_module_'):
+        name = name[len('ansible_module_'):]
+    return name
+
+
+def response_size(response):
+    if isinstance(response, (list, tuple)):
+        return sum([response_size(r) for r in response])
+    if isinstance(response, dict):
+        return len(json.dumps(response))
+    return len(str(response))
+
+
+STATE_DIR = os.environ.get('ANSIBLE_NXOS_STATE_DIR',
+                           os.path.expanduser('~/.ansible/nxos'))
+
+
+def state_path(kind, host):
+    """Returns the path of the local state file kept for host
+    """
+    path = os.path.join(STATE_DIR, kind)
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return os.path.join(path, host)
+
+
+def mark_save_pending(host):
+    open(state_path('pending_save', host), 'a').close()
+
+
+def save_pending(host):
+    return os.path.exists(state_path('pending_save', host))
+
+
+def pop_save_pending(host):
+    try:
+        os.remove(state_path('pending_save', host))
+        return True
+    except OSError:
+        return False
+
+
+# the cached config only follows the changes pushed through it. A change
+# made on the switch by anything else, such as the CLI or another control
+# node, is not seen until the cached config expires or is invalidated.
+# ANSIBLE_NXOS_CONFIG_CACHE_MAX_AGE bounds its age in seconds, counted from
+# the fetch, 0 keeps it until it is invalidated.
+CONFIG_CACHE_MAX_AGE = int(os.environ.get('ANSIBLE_NXOS_CONFIG_CACHE_MAX_AGE', 300))
+
+
+def config_cache_path(host, include_defaults=False):
+    if include_defaults:
+        return state_path('running_config_all', host)
+    return state_path('running_config', host)
+
+
+def cached_config_time(host, include_defaults=False):
+    """Returns when the cached config of host was fetched, None if not cached
+    """
+    try:
+        return os.path.getmtime(config_cache_path(host, include_defaults))
+    except OSError:
+        return None
+
+
+def read_cached_config(host, include_defaults=False, max_age=None):
+    if max_age is None:
+        max_age = CONFIG_CACHE_MAX_AGE
+    fetched = cached_config_time(host, include_defaults)
+    if fetched is None or (max_age and time.time() - fetched > max_age):
+        return None
+    try:
+        with open(config_cache_path(host, include_defaults)) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def write_cached_config(host, include_defaults, config, fetched=None):
+    """Caches config, fetched from the device at the time fetched, now by default
+    """
+    path = config_cache_path(host, include_defaults)
+    tmp = '%s.%s' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(config)
+    if fetched is not None:
+        # the modification time is the age of the cached config
+        os.utime(tmp, (fetched, fetched))
+    os.rename(tmp, path)
+
+
+def invalidate_cached_config(host):
+    for include_defaults in (False, True):
+        try:
+            os.remove(config_cache_path(host, include_defaults))
+        except OSError:
+            pass
+
+
+# commands that take a single value, a new value replaces the old line and
+# their negation removes it whatever its value
+SINGLE_VALUE_COMMANDS = [
+    'description',
+    'duplex',
+    'hostname',
+    'ip router ospf',
+    'mtu',
+    'router-id',
+    'source-interface',
+    'speed',
+    'switchport access vlan',
+    'switchport mode',
+    'vrf member'
+]
+
+# defaults the running config shows negated, "no shutdown" is a line of its
+# own that shutdown replaces, and the other way round
+NEGATED_LINES = ['shutdown', 'switchport', 'ip redirects', 'ipv6 redirects',
+                 'negotiate auto']
+
+# negations that remove more than their own section, "no feature bgp"
+# removes router bgp and "no vrf context" the vrf member of its interfaces
+CASCADING_COMMANDS = ['feature', 'vrf context']
+
+
+def single_value_command(text):
+    for command in SINGLE_VALUE_COMMANDS:
+        if text == command or text.startswith('%s ' % command):
+            return command
+
+
+def find_lines(config, parents, regex):
+    """Returns the lines right under parents, or at the top level, matching regex
+
+    config is a parsed config of the modules, its items and the children
+    of its lines are lists.
+    """
+    if parents:
+        obj = config.get_object(parents)
+        candidates = obj.children if obj else list()
+    else:
+        candidates = [item for item in config.items if not item.parents]
+    regex = re.compile(regex)
+    return [item for item in candidates if regex.search(item.text)]
+
+
+def remove_lines(config, lines):
+    """Removes lines from config, their sections with them
+    """
+    removed = set()
+    for item in lines:
+        stack = [item]
+        while stack:
+            line = stack.pop()
+            removed.add(id(line))
+            stack.extend(line.children)
+        if item.parents:
+            # lines compare equal by their text, a repeated line is not item
+            children = item.parents[-1].children
+            children[:] = [child for child in children if child is not item]
+    if removed:
+        config.items[:] = [item for item in config.items if id(item) not in removed]
+
+
+def delete_lines(config, parents, regex):
+    """Removes the lines under parents matching regex, returns how many
+    """
+    lines = find_lines(config, parents, regex)
+    remove_lines(config, lines)
+    return len(lines)
+
+
+def replace_line(config, parents, regex, text):
+    """Rewrites the line under parents matching regex as text, in place
+
+    text is added when no line matches, and further matches are removed.
+    """
+    lines = find_lines(config, parents, regex)
+    if not lines:
+        config.add(text, parents=parents)
+        return
+    line = lines[0]
+    indent = len(line.raw) - len(line.raw.lstrip())
+    line.text = text
+    line.raw = text.rjust(len(text) + indent)
+    remove_lines(config, lines[1:])
+
+
+def apply_line(config, item):
+    """Applies a pushed line to config, returns False if it cannot be modelled
+    """
+    parents = [p.text for p in item.parents]
+    negated = item.text.startswith('no ')
+    text = item.text[3:] if negated else item.text
+    command = single_value_command(text)
+
+    if not negated:
+        # a line replaces its negation, and a value the old value
+        regex = '^no %s$' % re.escape(text)
+        if command:
+            regex = '%s|^%s ' % (regex, re.escape(command))
+        replace_line(config, parents, regex, item.text)
+        return True
+
+    if text in NEGATED_LINES:
+        replace_line(config, parents, '^%s$' % re.escape(text), item.text)
+        return True
+
+    if item.children:
+        return False
+    for prefix in CASCADING_COMMANDS:
+        if text.startswith('%s ' % prefix):
+            return False
+
+    if command:
+        # without a value line the command is at its default already
+        delete_lines(config, parents, '^%s( |$)' % re.escape(command))
+        return True
+    # a line that is not there as is, abbreviated or with other arguments,
+    # cannot be told apart from one that was never there
+    return delete_lines(config, parents, '^%s$' % re.escape(text)) > 0
+
+
+def update_config(module, config, candidate):
+    """Writes the lines pushed from candidate through to the parsed config
+
+    config is the parsed config of the module run, and the cached config
+    of the host with cache_config. When a line cannot be modelled, both
+    are dropped and the next get_config() fetches the config again.
+    """
+    host = module.params['host']
+    include_defaults = module.params.get('include_defaults')
+    cache_config = module.params.get('cache_config')
+
+    if cache_config:
+        # the pushed lines leave the rest of the cached config as old as it was
+        fetched = cached_config_time(host, include_defaults)
+        invalidate_cached_config(host)
+
+    for item in candidate.items:
+        if item not in config.items and not apply_line(config, item):
+            module._config_cache.clear()
+            return
+
+    if cache_config:
+        write_cached_config(host, include_defaults, str(config), fetched)
+
+
+SNAPSHOT_CACHE_SIZE = int(os.environ.get('ANSIBLE_NXOS_SNAPSHOT_CACHE_SIZE',
+                                         64 * 1024 * 1024))
+
+
+def snapshot_path(digest):
+    return state_path('snapshots', digest)
+
+
+def read_snapshot(digest):
+    """Returns the parsed config snapshot stored under digest, if any
+    """
+    path = snapshot_path(digest)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+    # the modification time orders the snapshots for eviction
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return data
+
+
+def write_snapshot(digest, data, limit=None):
+    path = snapshot_path(digest)
+    tmp = '%s.%s' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+    evict_snapshots(SNAPSHOT_CACHE_SIZE if limit is None else limit)
+
+
+def evict_snapshots(limit):
+    """Removes the least recently used snapshots until they fit in limit bytes
+    """
+    path = os.path.dirname(snapshot_path('.'))
+    entries = list()
+    for name in os.listdir(path):
+        try:
+            stat = os.stat(os.path.join(path, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum([size for mtime, size, name in entries])
+    for mtime, size, name in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(os.path.join(path, name))
+        except OSError:
+            pass
+        total -= size
+
+
+# the queue of staged changes belongs to the run that filled it, so that
+# a run which failed before its nxos_commit does not leave its changes to
+# the next one. The workers of ansible-playbook and the modules they start
+# share its process group, ANSIBLE_NXOS_STAGE_ID names the queue instead
+# when runs share a process group, as those of a script do.
+STAGE_ID = os.environ.get('ANSIBLE_NXOS_STAGE_ID') or str(os.getpgrp())
+
+
+def staged_config_path(host):
+    return state_path('staged_config', '%s.%s' % (host, STAGE_ID))
+
+
+def stage_config_lines(host, lines):
+    """Queues indented config lines for host until nxos_commit applies them
+    """
+    with open(staged_config_path(host), 'a') as f:
+        f.write('%s\n' % json.dumps(list(lines)))
+
+
+def read_staged_config(host):
+    """Returns the blocks of config lines queued for host
+    """
+    try:
+        with open(staged_config_path(host)) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except IOError:
+        return list()
+
+
+def pop_staged_config(host):
+    """Returns and clears the blocks of config lines queued for host
+    """
+    blocks = read_staged_config(host)
+    try:
+        os.remove(staged_config_path(host))
+    except OSError:
+        pass
+    return blocks
+
+
+def merge_config_lines(blocks):
+    """Merges blocks of indented config lines into a single list of commands
+
+    Repeated lines are dropped, and every line keeps the place of its
+    first occurrence under its parents.
+    """
+    tree = collections.OrderedDict()
+
+    for block in blocks:
+        ancestors = [(-1, tree)]
+        for line in block:
+            text = line.strip()
+            if not text:
+                continue
+            indent = len(line) - len(line.lstrip())
+            while ancestors[-1][0] >= indent:
+                ancestors.pop()
+            children = ancestors[-1][1].setdefault(text, collections.OrderedDict())
+            ancestors.append((indent, children))
+
+    # features have to be enabled before the sections that need them
+    features = [(k, v) for k, v in tree.items() if k.startswith('feature ')]
+    others = [(k, v) for k, v in tree.items() if not k.startswith('feature ')]
+    tree = collections.OrderedDict(features + others)
+
+    commands = list()
+    depth = 0
+    stack = [(iter(tree.items()), list())]
+    while stack:
+        items, parents = stack[-1]
+        for text, children in items:
+            # coming back up from a deeper section, enter the parents
+            # again so the line is not applied in the wrong mode
+            if len(parents) < depth:
+                commands.extend(parents)
+            commands.append(text)
+            depth = len(parents)
+            stack.append((iter(children.items()), parents + [text]))
+            break
+        else:
+            stack.pop()
+
+    return commands
+
+
+class Cassette(object):
+    """The requests of a session and their responses, kept in a gzipped
+    file of one JSON object per exchange
+
+    Every exchange is appended as a gzip member of its own, so that the
+    runs of several modules can record to the same cassette.
+    """
+
+    # checkpoint names hold the time they were taken at
+    CHECKPOINT_RE = re.compile(r'(checkpoint) \S+$')
+
+    def __init__(self, path, transport=None):
+        self.path = path
+        self.transport = transport
+        self._exchanges = None
+
+    def key(self, kind, commands, output):
+        commands = [self.CHECKPOINT_RE.sub(r'\1 *', str(c)) for c in to_list(commands)]
+        return (kind, output, tuple(commands))
+
+    def record(self, kind, commands, output, seconds, response=None, error=None):
+        exchange = dict(transport=self.transport, kind=kind, output=output,
+                        commands=[str(c) for c in to_list(commands)],
+                        seconds=seconds, response=response, error=error)
+        f = gzip.open(self.path, 'ab')
+        try:
+            f.write(('%s\n' % json.dumps(exchange)).encode('utf-8'))
+        finally:
+            f.close()
+
+    def load(self):
+        self._exchanges = dict()
+        f = gzip.open(self.path, 'rb')
+        try:
+            for line in f:
+                exchange = json.loads(line.decode('utf-8'))
+                if self.transport is None:
+                    self.transport = exchange['transport']
+                key = self.key(exchange['kind'], exchange['commands'], exchange['output'])
+                self._exchanges.setdefault(key, collections.deque()).append(exchange)
+        finally:
+            f.close()
+
+    def replay(self, kind, commands, output):
+        """Returns the next recorded exchange for commands
+
+        Exchanges are served in the order they were recorded, and the last
+        one is served again once the others are used up.
+        """
+        exchanges = self._exchanges.get(self.key(kind, commands, output))
+        if not exchanges:
+            raise NetworkError(msg='no response recorded in %s' % self.path,
+                               commands=[str(c) for c in to_list(commands)])
+        if len(exchanges) > 1:
+            return exchanges.popleft()
+        return exchanges[0]
+
 
 class NxapiConfigMixin(object):
 
-    def get_config(self, include_defaults=False, **kwargs):
+    # transports that can send the checkpoint, the config lines and the
+    # checkpoint cleanup in one request implement _load_config_batch()
+    supports_config_batch = False
+
+    # with defer_save the startup-config copy is left to nxos_commit so
+    # that several changes to the same host share a single save
+    defer_save = False
+    host = None
+
+    # with a cassette every exchange with the device is recorded to it
+    cassette = None
+
+    # the transport named in request events
+    transport_name = None
+
+    # set while a traced call runs, the calls it makes belong to its span
+    _in_call = False
+
+    def _request(self, commands, send, sent=None, requests=1):
+        """Runs send() and reports the round trips it made to the request
+        hooks, send() returns the response and the bytes received
+        """
+        if 'request' not in HOOKS:
+            return send()[0]
+
+        commands = [str(c) for c in to_list(commands)]
+        if sent is None:
+            sent = sum([len(c) + 1 for c in commands])
+        event = dict(transport=self.transport_name, host=self.host, commands=commands,
+                     requests=requests, sent=sent, received=0, error=None,
+                     start=time.time())
+        try:
+            response, event['received'] = send()
+        except NetworkError:
+            event['error'] = str(get_exception())
+            self._report('request', event)
+            raise
+        self._report('request', event)
+        return response
+
+    def _traced(self, name, commands, call):
+        """Runs call() and reports it to the call hooks
+        """
+        if 'call' not in HOOKS or self._in_call:
+            return call()
+
+        event = dict(name=name, transport=self.transport_name, host=self.host,
+                     commands=[str(c) for c in to_list(commands)], size=0,
+                     error=None, start=time.time())
+        self._in_call = True
+        try:
+            response = call()
+        except NetworkError:
+            event['error'] = str(get_exception())
+            self._report('call', event)
+            raise
+        finally:
+            self._in_call = False
+        event['size'] = response_size(response)
+        self._report('call', event)
+        return response
+
+    def _report(self, hook, event):
+        # only calls that reached the device or failed on it are reported,
+        # any other exception is a bug of the caller and nothing was sent
+        event['seconds'] = time.time() - event['start']
+        run_hooks(hook, **event)
+
+    def _recorded(self, kind, commands, output, send):
+        if self.cassette is None:
+            return send()
+
+        start = time.time()
+        try:
+            response = send()
+        except NetworkError:
+            exc = get_exception()
+            error = dict(msg=str(exc))
+            try:
+                error.update(json.loads(json.dumps(getattr(exc, 'kwargs', None) or {})))
+            except (TypeError, ValueError):
+                pass
+            self.cassette.record(kind, commands, output, time.time() - start, error=error)
+            raise
+
+        self.cassette.record(kind, commands, output, time.time() - start, response=response)
+        return response
+
+    def get_config(self, include_defaults=False, section=None, **kwargs):
         cmd = 'show running-config'
+        if section and not section.startswith('|'):
+            cmd += ' %s' % section
         if include_defaults:
             cmd += ' all'
-        if isinstance(self, Nxapi):
+        if section and section.startswith('|'):
+            cmd += ' %s' % section
+        return self._traced('get_config', cmd, lambda: self._get_config(cmd))
+
+    def _get_config(self, cmd):
+        try:
             return self.execute([cmd], output='text')[0]
-        else:
+        except TypeError:
             return self.execute([cmd])[0]
 
     def load_config(self, config):
         checkpoint = 'ansible_%s' % int(time.time())
+        if self.supports_config_batch:
+            return self._load_config_batch(config, checkpoint)
+
         try:
             self.execute(['checkpoint %s' % checkpoint], output='text')
         except TypeError:
@@ -60,11 +1117,33 @@ class NxapiConfigMixin(object):
             self.execute(['no checkpoint %s' % checkpoint])
 
     def save_config(self, **kwargs):
+        if self.defer_save:
+            mark_save_pending(self.host)
+        else:
+            self._save_config()
+
+    def _save_config(self):
         try:
             self.execute(['copy running-config startup-config'], output='text')
         except TypeError:
             self.execute(['copy running-config startup-config'])
 
+    def flush_save_config(self):
+        """Runs the save deferred for this host, if any
+
+        Returns True when a save was pending and has been performed
+        """
+        if not pop_save_pending(self.host):
+            return False
+
+        try:
+            self._save_config()
+        except NetworkError:
+            mark_save_pending(self.host)
+            raise
+
+        return True
+
     def load_checkpoint(self, checkpoint):
         try:
             self.execute(['rollback running-config checkpoint %s' % checkpoint,
@@ -83,6 +1162,10 @@ class Nxapi(NxapiConfigMixin):
         'config': 'cli_conf'
     }
 
+    supports_config_batch = True
+
+    transport_name = 'nxapi'
+
     def __init__(self):
         self.url = None
         self.url_args = ModuleStub(url_argument_spec(), self._error)
@@ -137,6 +1220,10 @@ class Nxapi(NxapiConfigMixin):
             port = port or 80
 
         self.url = '%s://%s:%s/ins' % (proto, host, port)
+        self.host = host
+        self.defer_save = params.get('defer_save') or False
+        if params.get('cassette'):
+            self.cassette = Cassette(params['cassette'], 'nxapi')
         self._connected = True
 
     def disconnect(self, **kwargs):
@@ -147,74 +1234,105 @@ class Nxapi(NxapiConfigMixin):
     ### Command methods ###
 
     def execute(self, commands, output=None, **kwargs):
-        commands = collections.deque(commands)
+        commands = list(commands)
         output = output or self.default_output
+        send = lambda: self._recorded('execute', commands, output,
+                                      lambda: self._execute(commands, output))
+        return self._traced('execute', commands, send)
 
-        # only 10 commands can be encoded in each request
-        # messages sent to the remote device
+    def _execute(self, commands, output):
+        commands = collections.deque(commands)
+
+        # only 10 show commands can be encoded in each request
+        # messages sent to the remote device, config commands
+        # are sent in a single request
         stack = list()
         requests = list()
 
         while commands:
             stack.append(commands.popleft())
-            if len(stack) == 10:
+            if len(stack) == 10 and output != 'config':
                 body = self._get_body(stack, output)
                 data = self._jsonify(body)
-                requests.append(data)
+                requests.append((data, stack))
                 stack = list()
 
         if stack:
             body = self._get_body(stack, output)
             data = self._jsonify(body)
-            requests.append(data)
+            requests.append((data, stack))
 
-        headers = {'Content-Type': 'application/json'}
         result = list()
 
-        for req in requests:
-            if self._nxapi_auth:
-                headers['Cookie'] = self._nxapi_auth
+        for req, cmds in requests:
+            output = self._send(req, cmds)
+            for item in output:
+                if item['code'] != '200':
+                    self._error(output=output, **item)
+                else:
+                    result.append(item['body'])
 
-            response, headers = fetch_url(
-                self.url_args, self.url, data=data, headers=headers, method='POST'
-            )
-            self._nxapi_auth = headers.get('set-cookie')
+        return result
 
-            if 'Connection failure: timed out' == headers.get('msg'):
-                pass
-            else:
-                if headers['status'] != 200:
-                    self._error(**headers)
+    def _send(self, data, commands=None):
+        """Posts one encoded request and returns the output items
+        """
+        return self._request(commands, lambda: self._post(data), sent=len(data))
 
-                try:
-                    response = json.loads(response.read())
-                except ValueError:
-                    raise NetworkError(msg='unable to load response from device')
+    def _post(self, data):
+        headers = {'Content-Type': 'application/json'}
+        if self._nxapi_auth:
+            headers['Cookie'] = self._nxapi_auth
 
-                output = response['ins_api']['outputs']['output']
-                for item in to_list(output):
-                    if item['code'] != '200':
-                        self._error(output=output, **item)
-                    else:
-                        result.append(item['body'])
+        response, headers = fetch_url(
+            self.url_args, self.url, data=data, headers=headers, method='POST'
+        )
+        self._nxapi_auth = headers.get('set-cookie')
 
-        return result
+        if 'Connection failure: timed out' == headers.get('msg'):
+            return list(), 0
+
+        if headers['status'] != 200:
+            self._error(**headers)
+
+        data = response.read()
+        try:
+            response = json.loads(data)
+        except ValueError:
+            raise NetworkError(msg='unable to load response from device')
+
+        return to_list(response['ins_api']['outputs']['output']), len(data)
 
     def run_commands(self, commands, **kwargs):
-        output = None
-        cmds = list()
-        responses = list()
+        """Runs commands grouped by output type in as few requests as possible
 
-        for cmd in commands:
-            if output and output != cmd.output:
-                responses.extend(self.execute(cmds, output=output))
-                cmds = list()
+        Config commands stay where they are in the list so that show
+        commands before and after them still see the state they expect.
+        Responses are returned in the order the commands were given.
+        """
+        commands = list(commands)
+        responses = [None] * len(commands)
+
+        batches = list()
+        groups = collections.OrderedDict()
+
+        for index, cmd in enumerate(commands):
+            if cmd.output == 'config':
+                batches.extend(groups.items())
+                groups = collections.OrderedDict()
+                if batches and batches[-1][0] == 'config':
+                    batches[-1][1].append(index)
+                else:
+                    batches.append(('config', [index]))
+            else:
+                groups.setdefault(cmd.output, list()).append(index)
 
-            output = cmd.output
-            cmds.append(str(cmd))
+        batches.extend(groups.items())
 
-        if cmds:
-            responses.extend(self.execute(cmds, output=output))
+        for output, indexes in batches:
+            cmds = [str(commands[i]) for i in indexes]
+            for index, response in zip(indexes, self.execute(cmds, output=output)):
+                responses[index] = response
 
         return responses
 
@@ -225,6 +1343,26 @@ class Nxapi(NxapiConfigMixin):
         commands = to_list(commands)
         return self.execute(commands, output='config')
 
+    def _load_config_batch(self, config, checkpoint):
+        return self._recorded('config_batch', config, None,
+                              lambda: self._send_config_batch(config, checkpoint))
+
+    def _send_config_batch(self, config, checkpoint):
+        commands = ['checkpoint %s' % checkpoint]
+        commands.extend(to_list(config))
+        commands.append('no checkpoint %s' % checkpoint)
+
+        body = self._get_body(commands, 'config')
+        output = self._send(self._jsonify(body), commands)
+
+        for index, item in enumerate(output):
+            if item['code'] != '200':
+                # a failed checkpoint means nothing was applied and a failed
+                # cleanup means everything was, only roll back in between
+                if 0 < index < len(commands) - 1:
+                    self.load_checkpoint(checkpoint)
+                self._error(output=output, **item)
+
     def _jsonify(self, data):
         for encoding in ("utf-8", "latin-1"):
             try:
@@ -265,15 +1403,115 @@ class Cli(NxapiConfigMixin, CliBase):
 
     NET_PASSWD_RE = re.compile(r"[\r\n]?password: $", re.I)
 
+    pipeline_window = 1
+
+    transport_name = 'cli'
+
     def connect(self, params, **kwargs):
+        start = time.time()
         super(Cli, self).connect(params, kickstart=False, **kwargs)
         self.shell.send('terminal length 0')
+        self.pipeline_window = params.get('pipeline_window') or 1
+        self.host = params['host']
+        self.defer_save = params.get('defer_save') or False
+        if params.get('cassette'):
+            self.cassette = Cassette(params['cassette'], 'cli')
+        run_hooks('phase', name='connect', host=self.host, start=start,
+                  seconds=time.time() - start)
 
     ### Command methods ###
 
+    def execute(self, commands, output=None, **kwargs):
+        # the shell only returns text, output is taken as Nxapi.execute()
+        # takes it so that callers need not retry without it
+        send = lambda: self._recorded('execute', commands, None,
+                                      lambda: self._shell_execute(commands, **kwargs))
+        return self._traced('execute', commands, send)
+
+    def _shell_execute(self, commands, **kwargs):
+        # every command is a round trip of its own over the shell
+        send = lambda: self._received(super(Cli, self).execute(commands, **kwargs))
+        return self._request(commands, send, requests=len(to_list(commands)))
+
+    def _received(self, responses):
+        return responses, sum([len(str(r)) for r in responses])
+
+    def execute_pipelined(self, commands, window=None):
+        commands = list(commands)
+        return self._recorded('execute', commands, None,
+                              lambda: self._execute_pipelined(commands, window))
+
+    def _execute_pipelined(self, commands, window=None):
+        """Writes up to window commands ahead of the device and splits
+        the combined output on prompt boundaries
+        """
+        window = window or self.pipeline_window
+        responses = list()
+
+        for index in range(0, len(commands), window):
+            batch = commands[index:index + window]
+            if [cmd for cmd in batch if getattr(cmd, 'prompt', None)]:
+                # interactive commands need their answer sent after the
+                # device asks for it, so they cannot be written ahead
+                responses.extend(self._shell_execute(batch))
+            else:
+                responses.extend(self._send_window(batch))
+
+        return responses
+
+    def _send_window(self, commands):
+        return self._request(commands, lambda: self._received(self._write_window(commands)))
+
+    def _write_window(self, commands):
+        channel = self.shell.shell
+        prompt = re.compile(r'^%s ?' % re.escape(self.shell._matched_prompt.strip()), re.M)
+
+        data = ''
+        pos = 0
+        matches = list()
+
+        try:
+            channel.sendall(''.join(['%s\r' % str(cmd) for cmd in commands]))
+            while len(matches) < len(commands):
+                chunk = channel.recv(4096)
+                if not chunk:
+                    raise NetworkError(msg='connection closed by remote device',
+                                       commands=[str(c) for c in commands])
+                data += self.shell.strip(chunk)
+                for match in prompt.finditer(data, pos):
+                    matches.append(match)
+                    pos = match.end()
+                # lines before the last newline cannot start a prompt any more
+                pos = max(pos, data.rfind('\n') + 1)
+        except socket.timeout:
+            raise NetworkError(msg='timeout trying to send commands',
+                               commands=[str(c) for c in commands])
+        except socket.error:
+            exc = get_exception()
+            raise NetworkError(msg='problem sending commands to host: %s' % str(exc),
+                               commands=[str(c) for c in commands])
+
+        responses = list()
+        start = 0
+        for cmd, match in zip(commands, matches):
+            response = data[start:match.start()]
+            start = match.end()
+            for regex in self.CLI_ERRORS_RE:
+                if regex.search(response):
+                    raise NetworkError(
+                        msg='matched error in response: %s' % response,
+                        command=str(cmd)
+                    )
+            responses.append(self.shell.sanitize(cmd, response))
+
+        return responses
+
     def run_commands(self, commands):
         cmds = list(prepare_commands(commands))
-        responses = self.execute(cmds)
+        if self.pipeline_window > 1:
+            responses = self.execute_pipelined(cmds)
+        else:
+            responses = self.execute(cmds)
         for index, cmd in enumerate(commands):
             raw = cmd.args.get('raw') or False
             if cmd.output == 'json' and not raw:
@@ -297,6 +1535,85 @@ class Cli(NxapiConfigMixin, CliBase):
 Cli = register_transport('cli', default=True)(Cli)
 
 
+class Replay(NxapiConfigMixin):
+    """Serves the responses of a cassette recorded by the nxapi or cli
+    transport, optionally at the pace they were recorded at
+
+    Commands are sent through the methods of the transport that recorded
+    the cassette, so they are grouped and encoded the same way.
+    """
+
+    RECORDED_BY = {'nxapi': Nxapi, 'cli': Cli}
+
+    pipeline_window = 1
+
+    transport_name = 'replay'
+
+    def connect(self, params, **kwargs):
+        self.cassette = Cassette(params['cassette'])
+        self.cassette.load()
+        self.latency = params.get('replay_latency') or False
+        self.recorded_by = self.RECORDED_BY[self.cassette.transport]
+        self.supports_config_batch = self.recorded_by.supports_config_batch
+        self.default_output = 'json'
+        self.host = params['host']
+        self.defer_save = params.get('defer_save') or False
+        self._connected = True
+
+    def disconnect(self, **kwargs):
+        self._connected = False
+
+    def _replay(self, kind, commands, output):
+        commands = to_list(commands)
+        if self.recorded_by is Cli:
+            requests = len(commands)
+        elif kind == 'config_batch' or output == 'config':
+            requests = 1
+        else:
+            requests = (len(commands) + 9) // 10
+        return self._request(commands, lambda: self._serve(kind, commands, output),
+                             requests=requests)
+
+    def _serve(self, kind, commands, output):
+        exchange = self.cassette.replay(kind, commands, output)
+        if self.latency:
+            time.sleep(exchange['seconds'])
+        if exchange['error']:
+            raise NetworkError(**exchange['error'])
+        response = exchange['response']
+        return response, len(json.dumps(response))
+
+    def _call(self, name, *args, **kwargs):
+        # the function itself, so that it runs with a Replay as self
+        return self.recorded_by.__dict__[name](self, *args, **kwargs)
+
+    ### Command methods ###
+
+    def execute(self, commands, output=None, **kwargs):
+        if self.recorded_by is Nxapi:
+            output = output or self.default_output
+        else:
+            output = None
+        return self._traced('execute', commands,
+                            lambda: self._replay('execute', commands, output))
+
+    def execute_pipelined(self, commands, window=None):
+        return self.execute(commands)
+
+    def run_commands(self, commands, **kwargs):
+        return self._call('run_commands', commands, **kwargs)
+
+    ### Config methods ###
+
+    def configure(self, commands, **kwargs):
+        return self._call('configure', commands, **kwargs)
+
+    def _load_config_batch(self, config, checkpoint):
+        return self._replay('config_batch', config, None)
+
+Replay = register_transport('replay')(Replay)
+
+
 def prepare_config(commands):
     prepared = ['config']
     prepared.extend(to_list(commands))
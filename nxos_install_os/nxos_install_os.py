@@ -128,6 +128,46 @@ try:
 except ImportError:
     from ansible.module_utils.nxos import NetworkModule, NetworkError
 
+# the nxos module_utils shipped with nxos_install_os add the profile,
+# trace, metrics, cache_config and stage_config parameters, the fallbacks
+# below stand in for the functions the module calls whatever they are
+try:
+    from ansible.module_utils.nxos import read_cached_config, write_cached_config
+    from ansible.module_utils.nxos import invalidate_cached_config, cached_config_time
+except ImportError:
+    def cached_config_time(host, include_defaults=False):
+        return None
+
+    def read_cached_config(host, include_defaults=False, max_age=None):
+        return None
+
+    def write_cached_config(host, include_defaults, config, fetched=None):
+        pass
+
+    def invalidate_cached_config(host):
+        pass
+
+try:
+    from ansible.module_utils.nxos import stage_config_lines, mark_save_pending
+except ImportError:
+    stage_config_lines = mark_save_pending = None
+
+try:
+    from ansible.module_utils.nxos import update_config
+except ImportError:
+    def update_config(module, config, candidate):
+        # the pushed lines are not modelled, the config is fetched again
+        module._config_cache.clear()
+
+try:
+    from ansible.module_utils.nxos import instrument, run_phase
+except ImportError:
+    def instrument(module):
+        pass
+
+    def run_phase(name, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
 
 def to_list(val):
      if isinstance(val, (list, tuple)):
@@ -232,31 +272,66 @@ def get_network_module(**kwargs):
         return NetworkModule(**kwargs)
 
 def get_config(module, include_defaults=False):
-    config = module.params['config']
-    if not config:
-        try:
-            config = module.get_config()
-        except AttributeError:
-            defaults = module.params['include_defaults']
-            config = module.config.get_config(include_defaults=defaults)
-    return CustomNetworkConfig(indent=2, contents=config)
+    # the parsed config is kept for the rest of the module run, keyed
+    # on the include_defaults setting it was retrieved with
+    key = module.params.get('include_defaults')
+    cache = getattr(module, '_config_cache', None)
+    if cache is None:
+        cache = module._config_cache = dict()
+
+    if key not in cache:
+        config = module.params['config']
+        if not config:
+            config = fetch_config(module, key)
+        cache[key] = CustomNetworkConfig(indent=2, contents=config)
+    return cache[key]
+
+def fetch_config(module, include_defaults):
+    """Returns the running config from the host cache or the device
+
+    The host cache only sees the changes pushed by the modules that use
+    it, a change made elsewhere shows once it expires, see
+    ANSIBLE_NXOS_CONFIG_CACHE_MAX_AGE.
+    """
+    host = module.params['host']
+    if module.params.get('cache_config'):
+        config = read_cached_config(host, include_defaults)
+        if config:
+            return config
+
+    try:
+        config = module.get_config()
+    except AttributeError:
+        config = module.config.get_config(include_defaults=include_defaults)
+
+    if module.params.get('cache_config'):
+        write_cached_config(host, include_defaults, config)
+    return config
 
 def load_config(module, candidate):
     config = get_config(module)
 
-    commands = candidate.difference(config)
-    commands = [str(c).strip() for c in commands]
+    updates = candidate.difference(config)
+    commands = [str(c).strip() for c in updates]
 
     save_config = module.params['save']
 
     result = dict(changed=False)
 
     if commands:
-        if not module.check_mode:
+        if module.params.get('stage_config'):
+            # nxos_commit applies the changes staged by all modules
+            # in a single transaction, check mode only reports them
+            if not module.check_mode:
+                stage_config_lines(module.params['host'], [str(c) for c in updates])
+                if save_config:
+                    mark_save_pending(module.params['host'])
+        elif not module.check_mode:
             try:
                 module.configure(commands)
             except AttributeError:
                 module.config(commands)
+            update_config(module, config, candidate)
 
             if save_config:
                 try:
@@ -302,8 +377,7 @@ def execute_show(cmds, module, command_type=None):
     return response
 
 
-def execute_show_command(command, module, command_type='cli_show_ascii'):
-    cmds = [command]
+def execute_show_commands(cmds, module, command_type='cli_show_ascii'):
     if module.params['transport'] == 'cli':
         body = execute_show(cmds, module)
     elif module.params['transport'] == 'nxapi':
@@ -334,9 +408,9 @@ def get_boot_options(module):
     Returns:
         A dictionary, e.g. { 'kick': router_kick.img, 'sys': 'router_sys.img'}
     """
-    command = 'show boot'
-    
-    body = execute_show_command(command, module)[0]
+    # both commands go in a single request
+    commands = ['show boot', 'show install all status']
+    body, status = execute_show_commands(commands, module)
 
     boot_options_raw_text = body.split('Boot Variables on next reload')[1]
 
@@ -352,8 +426,7 @@ def get_boot_options(module):
         nxos = re.search(nxos_regex, boot_options_raw_text).group(1)
         retdict = dict(sys=nxos)
 
-    command = 'show install all status'
-    retdict['status'] = execute_show_command(command, module)[0]
+    retdict['status'] = status
 
     return retdict
 
@@ -387,6 +460,7 @@ def main():
     )
     module = get_network_module(argument_spec=argument_spec,
                                 supports_check_mode=True)
+    instrument(module)
 
     system_image_file = module.params['system_image_file']
     kickstart_image_file = module.params['kickstart_image_file']
@@ -394,7 +468,7 @@ def main():
     if kickstart_image_file == 'null':
         kickstart_image_file = None
 
-    current_boot_options = get_boot_options(module)
+    current_boot_options = run_phase('get_boot_options', get_boot_options, module)
     changed = False
     if not already_set(current_boot_options,
                        system_image_file,
@@ -402,9 +476,8 @@ def main():
         changed = True
 
     if not module.check_mode and changed == True:
-        set_boot_options(module,
-                         system_image_file,
-                         kickstart=kickstart_image_file)
+        run_phase('set_boot_options', set_boot_options, module,
+                  system_image_file, kickstart=kickstart_image_file)
 
         install_state = "Upgrade in progress."
     else:
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Runs NX-OS facts extractors over a directory of saved configs
+
+Every config is handled by a worker of a process pool, and one JSON
+object per config is written as soon as it is done, in no particular
+order:
+
+    {"file": "backups/leaf1.cfg", "facts": {"bgp": {...}}, "errors": {}}
+
+    python tools/audit.py backups/ --facts bgp --facts ospf_vrf \\
+        --param asn=65535 --param ospf=1 --output audit.ndjson
+
+The parameters are given to every extractor, the ones an extractor does
+not know about are ignored.
+"""
+
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+
+from offline import EXTRACTORS, missing_params, run_extractors
+
+_names = None
+_params = None
+
+
+def init_worker(names, params):
+    global _names, _params
+    _names = names
+    _params = params
+
+
+def audit_file(filename):
+    # the file is memory mapped, only the sections looked up are decoded
+    try:
+        facts, errors = run_extractors(None, _names, _params, filename)
+    except (IOError, OSError) as exc:
+        return dict(file=filename, facts=dict(), errors=dict(file=str(exc)))
+    return dict(file=filename, facts=facts, errors=errors)
+
+
+def iter_files(path):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.startswith('.'):
+                yield os.path.join(root, name)
+
+
+def parse_param(value):
+    key, sep, value = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('expected key=value, got %s' % key)
+    return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', help='directory of saved running configs')
+    parser.add_argument('--facts', action='append', choices=sorted(EXTRACTORS),
+                        help='extractors to run, all by default')
+    parser.add_argument('--param', action='append', type=parse_param, default=[],
+                        help='extractor parameter as key=value')
+    parser.add_argument('--output', help='NDJSON file to write, stdout by default')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='worker processes, one per cpu by default')
+    parser.add_argument('--tasks-per-worker', type=int, default=500,
+                        help='configs a worker handles before it is replaced, '
+                             'which bounds the memory it can hold on to')
+    args = parser.parse_args()
+
+    names = args.facts or sorted(EXTRACTORS)
+    params = dict(args.param)
+    missing = missing_params(names, params)
+    if missing:
+        parser.error('missing parameters: %s' % ', '.join(missing))
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    pool = multiprocessing.Pool(args.workers, init_worker, (names, params),
+                                maxtasksperchild=args.tasks_per_worker)
+    try:
+        for result in pool.imap_unordered(audit_file, iter_files(args.path), 8):
+            output.write('%s\n' % json.dumps(result, sort_keys=True))
+            output.flush()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Benchmarks tools/collect.py against a local mock NX-API fleet
+
+Every mock switch listens on a port of its own and answers show
+running-config with the same generated config, after the given latency.
+
+    python3 tools/bench_collect.py --switches 1000 --latency 0.05
+"""
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import concurrent.futures
+
+from benchmark import build_config
+from audit import parse_param
+from collect import Collector
+
+
+class MockSwitch(object):
+
+    def __init__(self, config, latency):
+        self.config = config
+        self.latency = latency
+        self.requests = 0
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                fields = dict()
+                while True:
+                    header = (await reader.readline()).decode('latin-1').strip()
+                    if not header:
+                        break
+                    key, sep, value = header.partition(':')
+                    fields[key.strip().lower()] = value.strip()
+                data = await reader.readexactly(int(fields.get('content-length', 0)))
+                request = json.loads(data.decode('utf-8'))['ins_api']
+
+                self.requests += 1
+                await asyncio.sleep(self.latency)
+                output = list()
+                for command in request['input'].split(' ;'):
+                    if request['type'] == 'cli_show_ascii' and command == 'show running-config':
+                        body = self.config
+                    else:
+                        body = dict()
+                    output.append(dict(code='200', msg='Success', input=command, body=body))
+                if len(output) == 1:
+                    output = output[0]
+                payload = json.dumps(dict(ins_api=dict(outputs=dict(output=output)))).encode('utf-8')
+
+                writer.write(('HTTP/1.1 200 OK\r\n'
+                              'Content-Type: application/json\r\n'
+                              'Set-Cookie: nxapi_auth=mock; Secure; HttpOnly\r\n'
+                              'Content-Length: %d\r\n\r\n' % len(payload)).encode('ascii'))
+                writer.write(payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def start_fleet(count, config, latency):
+    servers = list()
+    hosts = list()
+    switch = MockSwitch(config, latency)
+    for index in range(count):
+        server = await asyncio.start_server(switch.handle, '127.0.0.1', 0)
+        servers.append(server)
+        hosts.append(('127.0.0.1', server.sockets[0].getsockname()[1]))
+    return servers, hosts, switch
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--switches', type=int, default=1000)
+    parser.add_argument('--lines', type=int, default=2000,
+                        help='size of the config every switch returns')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds a switch takes to answer')
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--facts', action='append', default=None,
+                        help='extractors to run, vxlan_vtep by default')
+    parser.add_argument('--param', action='append', type=parse_param, default=[],
+                        help='extractor parameter as key=value')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    servers, hosts, switch = loop.run_until_complete(
+        start_fleet(args.switches, build_config(args.lines), args.latency))
+
+    executor = concurrent.futures.ProcessPoolExecutor(args.workers)
+    with open(os.devnull, 'w') as output:
+        params = dict(interface='nve1')
+        params.update(args.param)
+        collector = Collector(args.facts or ['vxlan_vtep'], params, output, executor,
+                              concurrency=args.concurrency, timeout=60)
+        start = time.time()
+        records = loop.run_until_complete(collector.run(hosts))
+        elapsed = time.time() - start
+    executor.shutdown()
+
+    for server in servers:
+        server.close()
+
+    seconds = [r['seconds'] for r in records]
+    failed = len([r for r in records if r['errors']])
+    print('%d switches, %d requests, %d failed in %.2fs, %.0f switches/s' % (
+        len(records), switch.requests, failed, elapsed, len(records) / elapsed))
+    print('per switch: p50 %.3fs p99 %.3fs max %.3fs' % (
+        percentile(seconds, 0.5), percentile(seconds, 0.99), max(seconds)))
+
+
+if __name__ == '__main__':
+    main()
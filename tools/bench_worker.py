@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Benchmarks the per-task latency of tools/worker.py against cold runs
+
+A cold task starts an interpreter that loads the facts modules and runs
+the extractors over the config file, as a module run does, short of
+ansible's own imports. A warm task is a request to a worker started
+ahead, with the config sent in the request or read from its file.
+
+    python tools/bench_worker.py --lines 10000 --tasks 50
+    python tools/bench_worker.py --facts bgp --param asn=65535
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+from offline import EXTRACTORS
+from genconfig import PARAMS, generate_lines
+from audit import parse_param
+from worker import Client
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+COLD_TASK = ('import sys, json\n'
+             'from offline import run_extractors\n'
+             'with open(sys.argv[1]) as f:\n'
+             '    facts, errors = run_extractors(f.read(), json.loads(sys.argv[2]),\n'
+             '                                   json.loads(sys.argv[3]))\n')
+
+
+def cold_task(python, filename, names, params):
+    start = time.time()
+    subprocess.check_call([python, '-c', COLD_TASK, filename, json.dumps(names),
+                           json.dumps(params)], cwd=TOOLS_DIR)
+    return time.time() - start
+
+
+def warm_task(client, names, params, config=None, filename=None):
+    start = time.time()
+    response = client.request(names, params, config=config, config_file=filename)
+    elapsed = time.time() - start
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return elapsed
+
+
+def start_worker(python, path):
+    proc = subprocess.Popen([python, os.path.join(TOOLS_DIR, 'worker.py'),
+                             '--socket', path, 'serve'], cwd=TOOLS_DIR)
+    deadline = time.time() + 60
+    while not os.path.exists(path):
+        if proc.poll() is not None or time.time() > deadline:
+            proc.kill()
+            raise RuntimeError('the worker did not start')
+        time.sleep(0.05)
+    return proc
+
+
+def summary(times):
+    times = sorted(times)
+    return dict(min=times[0], median=times[len(times) // 2],
+                p95=times[min(int(len(times) * 0.95), len(times) - 1)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--lines', type=int, default=10000,
+                        help='lines of the generated config')
+    parser.add_argument('--tasks', type=int, default=20, help='tasks per mode')
+    parser.add_argument('--facts', action='append', choices=sorted(EXTRACTORS),
+                        help='extractors run by every task, all by default')
+    parser.add_argument('--param', action='append', type=parse_param, default=[],
+                        help='extractor parameter as key=value, on top of the '
+                             'ones matching the generated config')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter to run the cold tasks and the worker with')
+    args = parser.parse_args()
+
+    names = args.facts or sorted(EXTRACTORS)
+    params = dict(PARAMS)
+    params.update(dict(args.param))
+
+    workdir = tempfile.mkdtemp(prefix='nxos-bench-worker-')
+    filename = os.path.join(workdir, 'running-config')
+    path = os.path.join(workdir, 'worker.sock')
+    config = generate_lines(args.lines)
+    with open(filename, 'w') as f:
+        f.write(config)
+
+    proc = start_worker(args.python, path)
+    client = Client(path)
+    try:
+        # the first request pays for what is left to warm up
+        errors = client.request(names, params, config_file=filename).get('errors')
+        for name, error in sorted((errors or dict()).items()):
+            sys.stderr.write('%s failed, %s\n' % (name, error))
+
+        results = [
+            ('cold', [cold_task(args.python, filename, names, params)
+                      for i in range(args.tasks)]),
+            ('warm-config', [warm_task(client, names, params, config=config)
+                             for i in range(args.tasks)]),
+            ('warm-file', [warm_task(client, names, params, filename=filename)
+                           for i in range(args.tasks)])
+        ]
+    finally:
+        client.close()
+        proc.terminate()
+        proc.wait()
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+    cold = summary(results[0][1])
+    print('%d config lines, %d extractors, %d tasks per mode' % (
+        config.count('\n'), len(names), args.tasks))
+    print('%-12s %10s %10s %10s %9s' % ('mode', 'min (s)', 'median (s)', 'p95 (s)', 'speedup'))
+    for mode, times in results:
+        stats = summary(times)
+        print('%-12s %10.4f %10.4f %10.4f %8.1fx' % (
+            mode, stats['min'], stats['median'], stats['p95'],
+            cold['median'] / stats['median']))
+
+
+if __name__ == '__main__':
+    main()
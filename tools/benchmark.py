@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Benchmarks the config parser and the extractors of the NX-OS facts modules
+
+The configs are generated by tools/genconfig.py at every --scale, or read
+from --file. Every case runs in a fresh process so that the peak RSS it
+reports belongs to that case alone, growth is the part of it taken by
+the case, setup included. The time is that of the operation alone.
+
+    python tools/benchmark.py --save baseline.json
+    python tools/benchmark.py --compare baseline.json --tolerance 0.25
+    python tools/benchmark.py --file running-config.txt --case parse-file
+
+With --compare, cases slower than their baseline by more than the
+tolerance are flagged and the exit status is 1.
+
+The parse-snapshot case reloads the snapshot that the facts modules
+store with cache_config set, it is written ahead by a process of its own.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+from offline import COMMON_MODULE, EXTRACTORS, load_facts_module, run_extractors
+from genconfig import PARAMS, generate_lines
+
+SCALES = [1000, 10000, 100000]
+
+# lines pushed by the add and difference cases, under new and existing parents
+CANDIDATE = [
+    (['interface Ethernet1/1'], 'description changed'),
+    (['interface Ethernet1/1'], 'ip ospf hello-interval 5'),
+    (['interface Ethernet1/4000'], 'description new'),
+    (['router bgp %s' % PARAMS['asn']], 'router-id 10.0.0.1'),
+    (['router bgp %s' % PARAMS['asn'], 'vrf VRF1', 'neighbor 172.0.0.200'], 'remote-as 65001'),
+    (['router ospf 1', 'vrf VRF1'], 'router-id 10.0.0.2'),
+    ([], 'ip route 10.10.10.0/24 10.0.0.1'),
+    (['evpn', 'vni 10001 l2'], 'route-target import 65535:1')
+]
+
+
+def build_config(lines):
+    return generate_lines(lines)
+
+
+def max_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on darwin and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        rss = rss // 1024
+    return rss
+
+
+def read(filename):
+    with open(filename) as f:
+        return f.read()
+
+
+def parse_string(common, filename):
+    contents = read(filename)
+    start = time.time()
+    common.CustomNetworkConfig(indent=2, contents=contents)
+    return time.time() - start
+
+
+def parse_file(common, filename):
+    start = time.time()
+    common.CustomNetworkConfig(indent=2).load_from_file(filename)
+    return time.time() - start
+
+
+def lookup_file_lazy(common, filename):
+    start = time.time()
+    config = common.CustomNetworkConfig(indent=2, lazy=True)
+    config.load_from_file(filename)
+    config.get_section('router bgp %s' % PARAMS['asn'])
+    return time.time() - start
+
+
+def get_section(common, filename):
+    config = common.CustomNetworkConfig(indent=2, contents=read(filename))
+    start = time.time()
+    for parents, line in CANDIDATE:
+        config.get_section(parents or [line])
+    return time.time() - start
+
+
+def add(common, filename):
+    config = common.CustomNetworkConfig(indent=2, contents=read(filename))
+    start = time.time()
+    for parents, line in CANDIDATE:
+        config.add(line, parents=parents)
+    return time.time() - start
+
+
+def difference(common, filename):
+    config = common.CustomNetworkConfig(indent=2, contents=read(filename))
+    candidate = common.CustomNetworkConfig(indent=2)
+    for parents, line in CANDIDATE:
+        candidate.add(line, parents=parents)
+    start = time.time()
+    candidate.difference(config)
+    return time.time() - start
+
+
+def to_string(common, filename):
+    config = common.CustomNetworkConfig(indent=2, contents=read(filename))
+    start = time.time()
+    str(config)
+    return time.time() - start
+
+
+def snapshot_filename(filename):
+    return '%s.snapshot' % filename
+
+
+def write_snapshot(filename):
+    common = load_facts_module(COMMON_MODULE)
+    config = common.CustomNetworkConfig(indent=2)
+    config.load_from_file(filename)
+    with open(snapshot_filename(filename), 'wb') as f:
+        f.write(config.dump_snapshot())
+
+
+def parse_snapshot(common, filename):
+    with open(snapshot_filename(filename), 'rb') as f:
+        data = f.read()
+    start = time.time()
+    common.CustomNetworkConfig(indent=2).load_snapshot(data)
+    return time.time() - start
+
+
+def extract(name):
+    def run(common, filename):
+        config = read(filename)
+        start = time.time()
+        facts, errors = run_extractors(config, [name], PARAMS)
+        if errors:
+            raise RuntimeError(errors[name])
+        return time.time() - start
+    return run
+
+
+CASES = [
+    ('parse-string', parse_string),
+    ('parse-file', parse_file),
+    ('parse-snapshot', parse_snapshot),
+    ('lookup-file-lazy', lookup_file_lazy),
+    ('get-section', get_section),
+    ('add', add),
+    ('difference', difference),
+    ('to-string', to_string)
+]
+CASES.extend([('facts-%s' % name, extract(name)) for name in sorted(EXTRACTORS)])
+
+
+def run_in_process(func, *args):
+    # a pool of one process per task gives every case a clean heap
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_case(case, filename, repeat):
+    common = load_facts_module(COMMON_MODULE)
+    func = dict(CASES)[case]
+    baseline = max_rss_kb()
+    try:
+        elapsed = min([func(common, filename) for i in range(repeat)])
+    except Exception as exc:
+        return dict(error='%s: %s' % (type(exc).__name__, exc))
+    return dict(seconds=elapsed, peak_rss_kb=max_rss_kb(),
+                growth_kb=max_rss_kb() - baseline)
+
+
+def compare(result, base, tolerance):
+    """Returns the ratio of result to base and whether it is a regression
+    """
+    if not base or 'seconds' not in base or 'seconds' not in result:
+        return None, False
+    # timer resolution makes ratios of very short cases meaningless
+    ratio = max(result['seconds'], 1e-4) / max(base['seconds'], 1e-4)
+    return ratio, ratio > 1 + tolerance
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--file', help='config to use instead of generated ones')
+    parser.add_argument('--scale', type=int, action='append',
+                        help='lines of the generated configs, %s by default' %
+                             ', '.join([str(s) for s in SCALES]))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per case, the fastest is reported')
+    parser.add_argument('--case', action='append', choices=[c[0] for c in CASES],
+                        help='cases to run, all by default')
+    parser.add_argument('--save', help='write the results to this JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to compare the results to')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slowdown over the baseline flagged as a regression')
+    args = parser.parse_args()
+
+    baseline = dict()
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    inputs = list()
+    if args.file:
+        with open(args.file) as f:
+            inputs.append((sum(1 for line in f), args.file, False))
+    else:
+        for scale in (args.scale or SCALES):
+            fd, filename = tempfile.mkstemp(prefix='nxos-bench-')
+            config = build_config(scale)
+            with os.fdopen(fd, 'w') as f:
+                f.write(config)
+            inputs.append((config.count('\n'), filename, True))
+
+    cases = args.case or [c[0] for c in CASES]
+    results = dict()
+    regressions = 0
+
+    print('%-28s %8s %10s %10s %14s %12s %8s' % ('case', 'lines', 'seconds', 'MB/s',
+                                                  'peak RSS (KB)', 'growth (KB)', 'ratio'))
+    try:
+        for lines, filename, generated in inputs:
+            size = os.path.getsize(filename)
+            if 'parse-snapshot' in cases:
+                run_in_process(write_snapshot, filename)
+
+            for case in cases:
+                result = run_in_process(run_case, case, filename, args.repeat)
+                key = '%s@%d' % (case, lines)
+                results[key] = result
+                if 'error' in result:
+                    print('%-28s %8d %s' % (case, lines, result['error']))
+                    continue
+
+                ratio, regressed = compare(result, baseline.get(key), args.tolerance)
+                regressions += regressed
+                # the throughput over the config, for every case alike
+                rate = size / max(result['seconds'], 1e-9) / (1024 * 1024)
+                print('%-28s %8d %10.4f %10.2f %14d %12d %8s%s' % (
+                    case, lines, result['seconds'], rate, result['peak_rss_kb'],
+                    result['growth_kb'], '%.2f' % ratio if ratio else '-',
+                    ' SLOWER' if regressed else ''))
+    finally:
+        for lines, filename, generated in inputs:
+            if os.path.exists(snapshot_filename(filename)):
+                os.remove(snapshot_filename(filename))
+            if generated:
+                os.remove(filename)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(python=sys.version.split()[0], repeat=args.repeat,
+                           results=results), f, indent=2, sort_keys=True)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Checks the round trips and bytes the modules exchange with a switch
+
+Every scenario of tools/budgets.json runs its module against the NX-API
+of tools/simulator.py, loaded with a config from tools/genconfig.py,
+and counts the requests and the payload bytes the switch sees. A
+scenario over its budget, or failing, makes the exit status 1.
+
+    python3 tools/budget.py --python python2.7 --ansible ansible-2.1.6.0/lib
+    python3 tools/budget.py --scenario static_route_vrf --update
+
+The modules run as scripts under --python, with the ansible lib of
+--ansible, stock 2.1 for the facts modules, or else the one found on
+PYTHONPATH. A scenario naming an ansible version runs with the lib
+given as --ansible VERSION=LIB instead, and is skipped without it:
+
+    python3 tools/budget.py --python python2.7 --ansible ansible-2.1.6.0/lib \
+        --ansible 2.2=ansible-2.2.3.0/lib
+
+The budgets are measured with stock ansible 2.1.6, and 2.2.3 with this
+repo's nxos.py for the scenarios naming 2.2. The first NX-API request
+of a 2.1 run is the one answered with the challenge for credentials.
+The blocks of a scenario's staged key are queued for nxos_commit, in a
+state directory of the run's own. --update writes the measured values to the budgets file, for when a
+change lowers them or is meant to raise them.
+"""
+
+import os
+import sys
+import json
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+
+from genconfig import generate_lines
+from simulator import Device, Link, NxapiServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+BUDGETS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'budgets.json')
+
+USERNAME = 'admin'
+PASSWORD = 'admin'
+
+# the queue of staged config the scenarios fill, see nxos.STAGE_ID
+STAGE_ID = 'budget'
+
+
+class Switch(object):
+    """A simulated switch served from a thread of its own
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = NxapiServer(Device(), Link(), USERNAME, PASSWORD)
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.server.handle, '127.0.0.1', 0), self.loop)
+        self.listener = future.result()
+        self.port = self.listener.sockets[0].getsockname()[1]
+
+    def reset(self, config, responses=None, rejects=None):
+        self.server.device = Device(config, responses=responses, rejects=rejects)
+        self.server.requests = 0
+        self.server.request_bytes = 0
+        self.server.response_bytes = 0
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _shutdown(self):
+        # connections a client left open are still being served
+        self.listener.close()
+        all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+        current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+        tasks = [t for t in all_tasks(self.loop) if not t.done()
+                 and t is not current_task(self.loop)]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def stage_blocks(state_dir, host, blocks):
+    """Queues blocks of config lines for host as the modules do for nxos_commit
+    """
+    path = os.path.join(state_dir, 'staged_config')
+    os.makedirs(path)
+    with open(os.path.join(path, '%s.%s' % (host, STAGE_ID)), 'w') as f:
+        for block in blocks:
+            f.write('%s\n' % json.dumps(block))
+
+
+def run_module(python, scenario, port, ansible=None):
+    """Runs the module of scenario and returns its result
+    """
+    args = dict(host='127.0.0.1', port=port, transport='nxapi',
+                username=USERNAME, password=PASSWORD)
+    args.update(scenario.get('args') or dict())
+
+    fd, filename = tempfile.mkstemp(prefix='nxos-budget-')
+    state_dir = tempfile.mkdtemp(prefix='nxos-budget-state-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(ANSIBLE_MODULE_ARGS=args), f)
+        stage_blocks(state_dir, args['host'], scenario.get('staged') or list())
+        env = dict(os.environ, ANSIBLE_NXOS_STATE_DIR=state_dir,
+                   ANSIBLE_NXOS_STAGE_ID=STAGE_ID)
+        if ansible:
+            env['PYTHONPATH'] = os.path.abspath(ansible)
+        proc = subprocess.Popen([python, os.path.join(ROOT, scenario['module']), filename],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        out, err = proc.communicate()
+    finally:
+        os.remove(filename)
+        shutil.rmtree(state_dir)
+
+    try:
+        return json.loads(out.decode('utf-8'))
+    except ValueError:
+        lines = (err or out).decode('utf-8', 'replace').strip().splitlines()
+        return dict(failed=True, msg=lines[-1] if lines else 'no output')
+
+
+def parse_ansible(value):
+    """Parses an --ansible value as a (version, lib) pair, version None by default
+    """
+    version, sep, lib = value.rpartition('=')
+    return version or None, lib
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--budgets', default=BUDGETS, help='budgets file')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter to run the modules with')
+    parser.add_argument('--ansible', action='append', type=parse_ansible, default=[],
+                        help='ansible lib directory the modules import, as LIB, or '
+                             'VERSION=LIB for the scenarios naming that version, '
+                             'PYTHONPATH by default')
+    parser.add_argument('--scenario', action='append', help='scenarios to run, all by default')
+    parser.add_argument('--update', action='store_true',
+                        help='write the measured values to the budgets file')
+    args = parser.parse_args()
+
+    with open(args.budgets) as f:
+        budgets = json.load(f)
+    scenarios = budgets['scenarios']
+    names = args.scenario or sorted(scenarios)
+    unknown = [n for n in names if n not in scenarios]
+    if unknown:
+        parser.error('unknown scenarios: %s' % ', '.join(unknown))
+
+    libs = dict(args.ansible)
+    config = generate_lines(budgets['config_lines'])
+    switch = Switch()
+    failures = 0
+
+    print('%-24s %16s %20s  %s' % ('scenario', 'requests', 'bytes', 'status'))
+    try:
+        for name in names:
+            scenario = scenarios[name]
+            version = scenario.get('ansible')
+            if version not in libs and version is not None:
+                print('%-24s %16s %20s  skipped, needs --ansible %s=LIB' % (
+                    name, '', '', version))
+                continue
+            switch.reset(config, scenario.get('responses'), scenario.get('rejects'))
+            result = run_module(args.python, scenario, switch.port, libs.get(version))
+
+            requests = switch.server.requests
+            size = switch.server.request_bytes + switch.server.response_bytes
+            over = [key for key, value in (('requests', requests), ('bytes', size))
+                    if scenario.get(key) is not None and value > scenario[key]]
+
+            if result.get('failed'):
+                status = 'FAILED: %s' % result.get('msg')
+                failures += 1
+            elif args.update:
+                scenario.update(requests=requests, bytes=size)
+                status = 'updated'
+            elif over:
+                status = 'OVER BUDGET: %s' % ', '.join(over)
+                failures += 1
+            elif scenario.get('requests') is None or scenario.get('bytes') is None:
+                status = 'no budget, set it with --update'
+            elif (requests, size) != (scenario['requests'], scenario['bytes']):
+                status = 'under budget, lower it with --update'
+            else:
+                status = 'ok'
+
+            print('%-24s %7d / %-6s %9d / %-8s  %s' % (
+                name, requests, scenario.get('requests'), size, scenario.get('bytes'), status))
+    finally:
+        switch.close()
+
+    if args.update:
+        with open(args.budgets, 'w') as f:
+            json.dump(budgets, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
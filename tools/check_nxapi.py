@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Checks the requests the NX-API transport sends to a switch
+
+Every check drives the Nxapi transport of nxos_install_os/nxos.py against
+tools/simulator.py, loaded with a config from tools/genconfig.py, and
+compares the requests the switch sees and the responses the transport
+returns with what they should be. The checks of the spans a transport
+traces also drive the Cli transport, over a shell answered by the
+simulated device rather than ssh. A failed check makes the exit status 1.
+
+    PYTHONPATH=ansible-2.2.3.0/lib python3 tools/check_nxapi.py
+    PYTHONPATH=ansible-2.2.3.0/lib python3 tools/check_nxapi.py --check execute_chunks
+
+The ansible on PYTHONPATH has to be 2.2, with this repo's nxos.py as
+its module_utils/nxos.py.
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+from ansible.module_utils.netcli import Command
+from ansible.module_utils.network import NetworkError
+from ansible.module_utils.nxos import Cli, Nxapi, Tracer
+
+from budget import Switch, USERNAME, PASSWORD
+from genconfig import generate_lines
+from simulator import Session
+
+CONFIG_LINES = 2000
+
+# show commands answered from the generated config, json and text alike
+SHOW_COMMANDS = ['show version', 'show hostname', 'show vrf',
+                 'show running-config interface Ethernet1/1']
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def expect(name, value, expected):
+    if value != expected:
+        raise CheckFailed('%s is %r, expected %r' % (name, value, expected))
+
+
+def connect(switch):
+    transport = Nxapi()
+    transport.connect(dict(host='127.0.0.1', port=switch.port, username=USERNAME,
+                           password=PASSWORD, use_ssl=False, validate_certs=False))
+    return transport
+
+
+class DeviceShell(object):
+    """Stands in for the ssh shell of the Cli transport, the simulated
+    device answers every command
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.session = Session()
+
+    def send(self, commands):
+        return [self.device.execute(self.session, str(c), output='text') for c in commands]
+
+
+class DeviceCli(Cli):
+    """The Cli transport connected to a DeviceShell, paramiko is not needed
+    """
+
+    def __init__(self, device):
+        self.shell = DeviceShell(device)
+        self._connected = True
+        self.default_output = 'text'
+        self.host = '127.0.0.1'
+
+
+def traced_spans(call):
+    """Runs call() and returns the spans it wrote to a trace file
+    """
+    fd, path = tempfile.mkstemp(prefix='nxos-check-', suffix='.jsonl')
+    os.close(fd)
+    tracer = Tracer(path, 'check_nxapi')
+    tracer.install()
+    try:
+        call()
+    finally:
+        tracer.uninstall()
+    try:
+        tracer.flush()
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+    finally:
+        os.remove(path)
+
+
+def run_alone(switch, commands):
+    """Returns the responses to commands run one request each, the reference"""
+    transport = connect(switch)
+    return [transport.execute([str(c)], output=c.output)[0] for c in commands]
+
+
+def check_run_commands_grouped(switch, transport):
+    """Interleaved json and text commands take a request per output type"""
+    commands = [Command(c, output=o) for c in SHOW_COMMANDS for o in ('json', 'text')]
+    expected = run_alone(switch, commands)
+    switch.server.requests = 0
+
+    responses = transport.run_commands(commands)
+    expect('requests', switch.server.requests, 2)
+    expect('responses', responses, expected)
+
+
+def check_run_commands_config(switch, transport):
+    """Config commands split the show commands around them, in order"""
+    show = 'show running-config interface Ethernet1/1'
+    commands = [Command(show, output='text'), Command('show hostname', output='json'),
+                Command(show, output='text'),
+                Command('interface Ethernet1/1', output='config'),
+                Command('description grouped', output='config'),
+                Command('show hostname', output='json'), Command(show, output='text')]
+    before = switch.server.device.render()
+    responses = transport.run_commands(commands)
+    # text and json before the config, the config, json and text after it
+    expect('requests', switch.server.requests, 5)
+    expect('show before the config', 'description grouped' in responses[0], False)
+    expect('show after the config', 'description grouped' in responses[-1], True)
+    expect('repeated show', responses[2], responses[0])
+    expect('changed config', before != switch.server.device.render(), True)
+
+
+def check_execute_chunks(switch, transport):
+    """Show commands go 10 to a request, config commands all in one"""
+    commands = [SHOW_COMMANDS[i % len(SHOW_COMMANDS)] for i in range(23)]
+    responses = transport.execute(commands, output='json')
+    expect('show requests', switch.server.requests, 3)
+    expect('show responses', len(responses), 23)
+
+    config = ['interface Ethernet1/%d' % (i // 2 + 1) if i % 2 == 0 else
+              'description chunk %d' % i for i in range(24)]
+    transport.execute(config, output='config')
+    expect('config requests', switch.server.requests, 4)
+    expect('applied', 'description chunk 23' in switch.server.device.render(), True)
+
+
+def check_load_config(switch, transport):
+    """The checkpoint, the lines and its cleanup go in a single request"""
+    transport.load_config(['interface Ethernet1/1', 'description applied',
+                           'interface Ethernet1/2', 'mtu 9216'])
+    expect('requests', switch.server.requests, 1)
+    expect('applied', 'description applied' in switch.server.device.render(), True)
+    expect('checkpoints', switch.server.device.checkpoints, dict())
+
+
+def load_rejected(switch, transport, config, text):
+    """Loads config on a switch rejecting text, returns the error raised"""
+    switch.server.device.rejects = [text]
+    try:
+        transport.load_config(config)
+    except NetworkError as exc:
+        return exc
+    raise CheckFailed('load_config() did not fail')
+
+
+def check_load_config_rollback(switch, transport):
+    """A line failing mid-batch rolls back the lines applied before it"""
+    before = switch.server.device.render()
+    load_rejected(switch, transport, ['interface Ethernet1/1', 'description rolled back',
+                                      'rejected line'], 'rejected line')
+    # the batch, then the rollback and the checkpoint cleanup
+    expect('requests', switch.server.requests, 2)
+    expect('config', switch.server.device.render(), before)
+    expect('checkpoints', switch.server.device.checkpoints, dict())
+
+
+def check_load_config_checkpoint(switch, transport):
+    """A failed checkpoint stops the batch before any line, with no rollback"""
+    before = switch.server.device.render()
+    load_rejected(switch, transport, ['interface Ethernet1/1', 'description unapplied'],
+                  'checkpoint')
+    expect('requests', switch.server.requests, 1)
+    expect('config', switch.server.device.render(), before)
+
+
+def expect_spans(transport):
+    """One get_config() is one call span and one request span"""
+    spans = traced_spans(transport.get_config)
+    expect('call spans', [s['name'] for s in spans if s['event'] == 'call'],
+           ['get_config'])
+    expect('request spans', [s['name'] for s in spans if s['event'] == 'request'],
+           ['show running-config'])
+
+
+def check_get_config_span(switch, transport):
+    """get_config() over NX-API is traced as a single call"""
+    expect_spans(transport)
+
+
+def check_get_config_span_cli(switch, transport):
+    """get_config() over the CLI is traced as a single call, with no retry"""
+    expect_spans(DeviceCli(switch.server.device))
+
+
+CHECKS = [
+    ('run_commands_grouped', check_run_commands_grouped),
+    ('run_commands_config', check_run_commands_config),
+    ('execute_chunks', check_execute_chunks),
+    ('load_config', check_load_config),
+    ('load_config_rollback', check_load_config_rollback),
+    ('load_config_checkpoint', check_load_config_checkpoint),
+    ('get_config_span', check_get_config_span),
+    ('get_config_span_cli', check_get_config_span_cli),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--check', action='append', choices=[c[0] for c in CHECKS],
+                        help='checks to run, all by default')
+    args = parser.parse_args()
+
+    config = generate_lines(CONFIG_LINES)
+    switch = Switch()
+    failures = 0
+
+    print('%-24s %9s  %s' % ('check', 'requests', 'status'))
+    try:
+        for name, func in CHECKS:
+            if args.check and name not in args.check:
+                continue
+            switch.reset(config)
+            try:
+                func(switch, connect(switch))
+                status = 'ok'
+            except Exception as exc:
+                status = 'FAILED: %s: %s' % (type(exc).__name__, exc)
+                failures += 1
+            print('%-24s %9d  %s' % (name, switch.server.requests, status))
+    finally:
+        switch.close()
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Collects NX-OS facts from a fleet of switches over NX-API
+
+A single process drives the NX-API sessions of all the switches with
+asyncio, while the facts extractors run over the fetched configs in a
+pool of worker processes. One JSON object per switch is written as soon
+as it is done:
+
+    {"host": "leaf1", "facts": {"bgp": {...}}, "errors": {}, "seconds": 0.4}
+
+    python3 tools/collect.py hosts.txt --username admin --password admin \\
+        --facts bgp --param asn=65535 --output facts.ndjson
+
+The hosts file holds one host[:port] per line. Requires python 3.5.
+"""
+
+import sys
+import ssl
+import json
+import time
+import base64
+import asyncio
+import argparse
+import collections
+import multiprocessing
+import concurrent.futures
+
+from ansible.module_utils.network import NetworkError, to_list
+from ansible.module_utils.nxos import Nxapi
+
+from offline import EXTRACTORS, missing_params, run_extractors
+from audit import parse_param
+
+# requests are encoded the way the nxapi transport encodes them, this
+# instance is never connected
+ENCODER = Nxapi()
+
+
+class NxapiSession(object):
+    """NX-API requests to a single switch, a connection each
+
+    A collection sends a single request per switch, so the connection is
+    closed with its response and no session cookie is kept.
+    """
+
+    def __init__(self, host, port=None, username=None, password=None,
+                 use_ssl=False, validate_certs=True, timeout=30):
+        self.host = host
+        self.port = port or (443 if use_ssl else 80)
+        self.timeout = timeout
+        self._auth = None
+        if username:
+            token = base64.b64encode(('%s:%s' % (username, password or '')).encode('utf-8'))
+            self._auth = 'Basic %s' % token.decode('ascii')
+        self._ssl = None
+        if use_ssl:
+            self._ssl = ssl.create_default_context()
+            if not validate_certs:
+                self._ssl.check_hostname = False
+                self._ssl.verify_mode = ssl.CERT_NONE
+        self._reader = None
+        self._writer = None
+
+    @property
+    def url(self):
+        proto = 'https' if self._ssl else 'http'
+        return '%s://%s:%s/ins' % (proto, self.host, self.port)
+
+    async def execute(self, commands, output='json'):
+        """Runs commands in a single request and returns their bodies
+        """
+        body = ENCODER._get_body(to_list(commands), output)
+        data = ENCODER._jsonify(body).encode('utf-8')
+
+        try:
+            status, payload = await asyncio.wait_for(self._post(data), self.timeout)
+        except (asyncio.IncompleteReadError, IndexError, ValueError) as exc:
+            # the switch closed the connection early or sent a malformed response
+            raise NetworkError('invalid response from device: %s: %s'
+                               % (type(exc).__name__, exc), url=self.url)
+        finally:
+            self.close()
+        if status != 200:
+            raise NetworkError('unexpected status %s' % status, url=self.url)
+
+        try:
+            response = json.loads(payload.decode('utf-8'))
+        except ValueError:
+            raise NetworkError('unable to load response from device', url=self.url)
+
+        try:
+            output = to_list(response['ins_api']['outputs']['output'])
+        except (KeyError, TypeError):
+            raise NetworkError('unable to load response from device', url=self.url)
+        for item in output:
+            if item.get('code') != '200':
+                error = dict(item)
+                error.setdefault('url', self.url)
+                raise NetworkError(**error)
+        return [item['body'] for item in output]
+
+    async def _post(self, data):
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self._ssl)
+
+        headers = ['POST /ins HTTP/1.1',
+                   'Host: %s' % self.host,
+                   'Content-Type: application/json',
+                   'Content-Length: %d' % len(data),
+                   'Connection: close']
+        if self._auth:
+            headers.append('Authorization: %s' % self._auth)
+        self._writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('ascii') + data)
+        await self._writer.drain()
+
+        status = int((await self._reader.readline()).split()[1])
+        fields = dict()
+        while True:
+            line = (await self._reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            key, sep, value = line.partition(':')
+            fields[key.strip().lower()] = value.strip()
+
+        if fields.get('transfer-encoding') == 'chunked':
+            payload = await self._read_chunked()
+        else:
+            payload = await self._reader.readexactly(int(fields.get('content-length', 0)))
+        return status, payload
+
+    async def _read_chunked(self):
+        chunks = list()
+        while True:
+            size = int((await self._reader.readline()).split(b';')[0], 16)
+            if not size:
+                await self._reader.readline()
+                return b''.join(chunks)
+            chunks.append(await self._reader.readexactly(size))
+            await self._reader.readline()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class Collector(object):
+    """Fetches the running config of hosts and runs the extractors over it
+
+    At most concurrency sessions are open at once, and at most per_host of
+    them to the same host.
+    """
+
+    def __init__(self, names, params, output, executor=None, concurrency=200,
+                 per_host=1, **session_args):
+        self.names = names
+        self.params = params
+        self.output = output
+        self.executor = executor
+        self.session_args = session_args
+        self.per_host = per_host
+        self._slots = asyncio.Semaphore(concurrency)
+        self._host_slots = collections.defaultdict(lambda: asyncio.Semaphore(self.per_host))
+
+    async def collect(self, host, port=None):
+        start = time.time()
+        record = dict(host=host if port is None else '%s:%s' % (host, port),
+                      facts=dict(), errors=dict())
+
+        async with self._host_slots[host, port]:
+            async with self._slots:
+                session = NxapiSession(host, port, **self.session_args)
+                try:
+                    config = (await session.execute('show running-config', 'text'))[0]
+                except (NetworkError, OSError, asyncio.TimeoutError) as exc:
+                    record['errors']['connection'] = '%s: %s' % (type(exc).__name__, exc)
+                    config = None
+
+        if config is not None:
+            loop = asyncio.get_event_loop()
+            try:
+                facts, errors = await loop.run_in_executor(self.executor, run_extractors,
+                                                           config, self.names, self.params)
+            except Exception as exc:
+                # a worker process died, the other hosts are still collected
+                record['errors']['extractors'] = '%s: %s' % (type(exc).__name__, exc)
+            else:
+                record['facts'] = facts
+                record['errors'].update(errors)
+
+        record['seconds'] = time.time() - start
+        self.output.write('%s\n' % json.dumps(record, sort_keys=True))
+        self.output.flush()
+        return record
+
+    async def run(self, hosts):
+        # collect() reports the errors of its host, this only keeps a bug
+        # in it from cancelling the collection of the other hosts
+        return await asyncio.gather(*[self.collect(host, port) for host, port in hosts],
+                                    return_exceptions=True)
+
+
+def read_hosts(filename):
+    hosts = list()
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                host, sep, port = line.partition(':')
+                hosts.append((host, int(port) if port else None))
+    return hosts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('hosts', help='file of host[:port] lines')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--use-ssl', action='store_true')
+    parser.add_argument('--no-validate-certs', dest='validate_certs', action='store_false')
+    parser.add_argument('--facts', action='append', choices=sorted(EXTRACTORS),
+                        help='extractors to run, all by default')
+    parser.add_argument('--param', action='append', type=parse_param, default=[],
+                        help='extractor parameter as key=value')
+    parser.add_argument('--output', help='NDJSON file to write, stdout by default')
+    parser.add_argument('--concurrency', type=int, default=200,
+                        help='sessions open at once')
+    parser.add_argument('--per-host', type=int, default=1,
+                        help='sessions open at once to the same host')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds to wait for each request')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='processes running the extractors')
+    args = parser.parse_args()
+
+    names = args.facts or sorted(EXTRACTORS)
+    params = dict(args.param)
+    missing = missing_params(names, params)
+    if missing:
+        parser.error('missing parameters: %s' % ', '.join(missing))
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    executor = concurrent.futures.ProcessPoolExecutor(args.workers)
+    loop = asyncio.get_event_loop()
+    try:
+        collector = Collector(names, params, output, executor,
+                              concurrency=args.concurrency, per_host=args.per_host,
+                              username=args.username, password=args.password,
+                              use_ssl=args.use_ssl, validate_certs=args.validate_certs,
+                              timeout=args.timeout)
+        loop.run_until_complete(collector.run(read_hosts(args.hosts)))
+    finally:
+        executor.shutdown()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
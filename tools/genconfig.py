@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Generates NX-OS running configs of a chosen size
+
+The configs are laid out the way a VXLAN EVPN leaf shows them, with
+VRFs, VLANs mapped to VNIs, ACLs, routed interfaces running OSPF, an NVE
+interface, static routes, OSPF and BGP with neighbors in every VRF, and
+the EVPN section.
+
+    python tools/genconfig.py --lines 10000 > leaf.cfg
+    python tools/genconfig.py --interfaces 96 --vrfs 8 --neighbors 32
+
+The names used are the ones in PARAMS, which the facts extractors can be
+pointed at.
+"""
+
+import argparse
+
+ASN = '65535'
+
+# extractor parameters that match what generate_config() produces
+PARAMS = dict(asn=ASN, vrf='VRF1', neighbor='10.255.0.1', afi='ipv4',
+              safi='unicast', interface='Ethernet1/1', ospf='1', vni='10001',
+              prefix='192.168.0.0/24')
+
+
+def generate_config(interfaces=48, vrfs=4, neighbors=16, vnis=8, routes=16,
+                    acls=4, acl_entries=10):
+    lines = ['hostname bench',
+             'feature bgp',
+             'feature ospf',
+             'feature interface-vlan',
+             'feature vn-segment-vlan-based',
+             'feature nv overlay',
+             'nv overlay evpn',
+             'fabric forwarding anycast-gateway-mac 0000.2222.3333']
+
+    vrf_names = ['VRF%d' % v for v in range(1, vrfs + 1)]
+    for index, vrf in enumerate(vrf_names):
+        lines.extend([
+            'vrf context %s' % vrf,
+            '  vni %d' % (50000 + index),
+            '  rd auto',
+            '  address-family ipv4 unicast',
+            '    route-target both auto',
+            '    route-target both auto evpn'
+        ])
+        for route in range(routes // max(vrfs, 1)):
+            lines.append('  ip route 172.%d.%d.0/24 10.%d.0.1' % (16 + index % 16, route % 256, index % 256))
+
+    for route in range(routes):
+        lines.append('ip route 192.168.%d.0/24 10.0.%d.1' % (route % 256, route // 256 % 256))
+
+    for vni in range(vnis):
+        lines.extend(['vlan %d' % (100 + vni), '  vn-segment %d' % (10001 + vni)])
+
+    for acl in range(acls):
+        lines.append('ip access-list ACL-%d' % acl)
+        for entry in range(acl_entries):
+            lines.append('  %d permit tcp 10.%d.%d.0/24 any eq %d' % (
+                (entry + 1) * 10, acl % 256, entry % 256, 1024 + entry))
+
+    for index in range(interfaces):
+        vrf = vrf_names[index % len(vrf_names)] if vrf_names else None
+        lines.extend([
+            'interface Ethernet1/%d' % (index + 1),
+            '  description uplink %d' % (index + 1),
+            '  no switchport',
+            '  mtu 9216'
+        ])
+        if vrf and index % 4 == 3:
+            lines.append('  vrf member %s' % vrf)
+        lines.extend([
+            '  ip address 10.%d.%d.1/30' % (index // 64 % 256, index * 4 % 256),
+            '  ip ospf cost %d' % (10 + index % 10),
+            '  ip router ospf 1 area 0.0.0.0',
+            '  no shutdown'
+        ])
+
+    lines.extend(['interface loopback0', '  ip address 10.255.255.1/32',
+                  '  ip router ospf 1 area 0.0.0.0'])
+    lines.extend(['interface nve1', '  no shutdown', '  source-interface loopback0',
+                  '  host-reachability protocol bgp'])
+    for vni in range(vnis):
+        lines.extend(['  member vni %d' % (10001 + vni),
+                      '    ingress-replication protocol bgp'])
+
+    lines.extend(['router ospf 1', '  router-id 10.255.255.1'])
+    for vrf in vrf_names:
+        lines.extend(['  vrf %s' % vrf, '    router-id 10.255.255.1'])
+
+    lines.extend(['router bgp %s' % ASN,
+                  '  router-id 10.255.255.1',
+                  '  log-neighbor-changes',
+                  '  address-family ipv4 unicast',
+                  '    maximum-paths 4',
+                  '  address-family l2vpn evpn'])
+    per_vrf = neighbors // (len(vrf_names) + 1)
+    for index in range(neighbors - per_vrf * len(vrf_names)):
+        lines.extend(bgp_neighbor('10.255.%d.%d' % (index // 250, index % 250 + 1), '  '))
+    for vrf_index, vrf in enumerate(vrf_names):
+        lines.extend(['  vrf %s' % vrf, '    router-id 10.255.255.1',
+                      '    address-family ipv4 unicast', '      maximum-paths 2'])
+        for index in range(per_vrf):
+            lines.extend(bgp_neighbor('172.%d.%d.%d' % (vrf_index % 256, index // 250,
+                                                        index % 250 + 1), '    '))
+
+    lines.append('evpn')
+    for vni in range(vnis):
+        lines.extend(['  vni %d l2' % (10001 + vni),
+                      '    rd auto',
+                      '    route-target import auto',
+                      '    route-target export auto'])
+
+    return '\n'.join(lines) + '\n'
+
+
+def bgp_neighbor(address, indent):
+    return ['%sneighbor %s' % (indent, address),
+            '%s  remote-as 65000' % indent,
+            '%s  description peer %s' % (indent, address),
+            '%s  update-source loopback0' % indent,
+            '%s  address-family ipv4 unicast' % indent,
+            '%s    send-community both' % indent]
+
+
+def generate_lines(lines):
+    """Returns a config of about lines lines, every part growing with it
+    """
+    # the parts below come to about 0.72 lines per unit of scale
+    scale = max(lines * 100 // 72, 200)
+    return generate_config(interfaces=scale // 20, vrfs=max(scale // 2500, 1),
+                           neighbors=scale // 60, vnis=scale // 100,
+                           routes=scale // 20, acls=max(scale // 1000, 1),
+                           acl_entries=20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--lines', type=int,
+                        help='about how many lines to generate, every part scaled to it')
+    parser.add_argument('--interfaces', type=int, default=48)
+    parser.add_argument('--vrfs', type=int, default=4)
+    parser.add_argument('--neighbors', type=int, default=16)
+    parser.add_argument('--vnis', type=int, default=8)
+    parser.add_argument('--routes', type=int, default=16)
+    parser.add_argument('--acls', type=int, default=4)
+    args = parser.parse_args()
+
+    if args.lines:
+        config = generate_lines(args.lines)
+    else:
+        config = generate_config(args.interfaces, args.vrfs, args.neighbors,
+                                 args.vnis, args.routes, args.acls)
+    print(config.rstrip('\n'))
+
+
+if __name__ == '__main__':
+    main()
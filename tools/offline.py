@@ -0,0 +1,202 @@
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Runs the extractors of the NX-OS facts modules outside of ansible
+
+The facts modules read the running config from their running_config
+parameter when it is set, OfflineModule stands in for the ansible module
+and hands them a saved config instead of a device.
+"""
+
+import os
+import re
+
+FACTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, 'library', 'facts-wip')
+
+# any facts module carries the common code, the parser included
+COMMON_MODULE = 'nxos_vxlan_vtep_facts'
+
+
+class OfflineError(Exception):
+    pass
+
+
+def load_facts_module(name):
+    path = os.path.join(FACTS_DIR, '%s.py' % name)
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class SharedConfig(object):
+    """The parsed config cache of a facts module, holding a single config
+
+    get_config() keys its cache on the scope of the lookup, each scope
+    would parse the config again. Offline every scope is answered from
+    the whole config, parsed once.
+    """
+
+    def __init__(self, netcfg):
+        self.netcfg = netcfg
+
+    def __contains__(self, key):
+        return True
+
+    def __getitem__(self, key):
+        return self.netcfg
+
+
+class OfflineModule(object):
+    """A stand-in for the ansible module of a facts module
+
+    The config is given as text, or as the name of a saved config which
+    is memory mapped rather than read. The only commands it answers are
+    the ones the config can answer, anything else needs a device and
+    raises OfflineError.
+    """
+
+    def __init__(self, config, params=None, filename=None):
+        self.params = dict(running_config=config, include_defaults=True,
+                           transport='nxapi', host=None, cache_config=False)
+        self.params.update(params or dict())
+        self.check_mode = True
+        self.filename = filename
+        self._config_cache = SharedConfig(parse_config(config, filename))
+
+    def execute(self, commands, **kwargs):
+        if commands in ('show vrf', ['show vrf']):
+            return [self._show_vrf()]
+        raise OfflineError('%s needs a device' % commands)
+
+    def _show_vrf(self):
+        names = ['default']
+        if self.filename:
+            with open(self.filename) as f:
+                for line in f:
+                    if line.startswith('vrf context '):
+                        names.extend(line.split()[2:3])
+        else:
+            names.extend(re.findall(r'^vrf context (\S+)', self.params['running_config'], re.M))
+        return dict(TABLE_vrf=dict(ROW_vrf=[dict(vrf_name=n) for n in names]))
+
+    def fail_json(self, **kwargs):
+        raise OfflineError(kwargs.get('msg'))
+
+
+def get_static_routes(facts, module):
+    return facts.get_existing_routes(module, module.params['vrf'], list())
+
+
+def get_vxlan_vtep_vni(facts, module):
+    existing, interface_exist = facts.get_existing(module)
+    return existing
+
+
+# name: (facts module, required params, default params, extractor)
+EXTRACTORS = {
+    'bgp': ('nxos_bgp_facts', ['asn'], dict(vrf='default'),
+            lambda facts, module: facts.get_bgp_facts(module)),
+    'bgp_af': ('nxos_bgp_af_facts', ['asn', 'afi', 'safi'], dict(vrf='default'),
+               lambda facts, module: facts.get_existing(module)),
+    'bgp_neighbor': ('nxos_bgp_neighbor_facts', ['asn', 'neighbor'], dict(vrf='default'),
+                     lambda facts, module: facts.get_existing(module)),
+    'bgp_neighbor_af': ('nxos_bgp_neighbor_af_facts', ['asn', 'neighbor'],
+                        dict(vrf='default', afi=None, safi=None),
+                        lambda facts, module: facts.get_existing(module)),
+    'evpn_vni': ('nxos_evpn_vni_facts', ['vni'], dict(),
+                 lambda facts, module: facts.get_existing(module)),
+    'interface_ospf': ('nxos_interface_ospf_facts', ['interface'], dict(),
+                       lambda facts, module: facts.get_existing(module)),
+    'ospf': ('nxos_ospf_facts', [], dict(),
+             lambda facts, module: facts.get_existing(module)),
+    'ospf_vrf': ('nxos_ospf_vrf_facts', ['ospf'], dict(vrf='default'),
+                 lambda facts, module: facts.get_existing(module)),
+    'overlay_global': ('nxos_overlay_global_facts', [], dict(),
+                       lambda facts, module: facts.get_existing(module)),
+    'static_route': ('nxos_static_route_facts', [], dict(prefix=None, vrf=None),
+                     get_static_routes),
+    'vxlan_vtep': ('nxos_vxlan_vtep_facts', ['interface'], dict(),
+                   lambda facts, module: facts.get_existing(module)),
+    'vxlan_vtep_vni': ('nxos_vxlan_vtep_vni_facts', ['interface', 'vni'], dict(),
+                       get_vxlan_vtep_vni)
+}
+
+_loaded = dict()
+
+
+def get_loaded_module(module_name):
+    if module_name not in _loaded:
+        _loaded[module_name] = load_facts_module(module_name)
+    return _loaded[module_name]
+
+
+def get_facts_module(name):
+    """Returns the facts module of the extractor name, loaded once per process
+    """
+    return get_loaded_module(EXTRACTORS[name][0])
+
+
+def get_common_module():
+    """Returns the facts module whose parser loads the configs
+    """
+    return get_loaded_module(COMMON_MODULE)
+
+
+def parse_config(config=None, filename=None):
+    """Returns config parsed, or the saved config filename through a memory map
+    """
+    netcfg = get_common_module().CustomNetworkConfig(indent=2, lazy=True)
+    if filename:
+        netcfg.load_from_file(filename)
+    else:
+        netcfg.load(config or '')
+    return netcfg
+
+
+def missing_params(names, params):
+    missing = set()
+    for name in names:
+        missing.update([p for p in EXTRACTORS[name][1] if p not in params])
+    return sorted(missing)
+
+
+def run_extractors(config, names, params, filename=None):
+    """Runs the extractors names over config, or the saved config filename
+
+    The parsed config is shared by all of them. Returns the facts and the
+    errors, both keyed by extractor. A file that cannot be read raises
+    IOError or OSError.
+    """
+    module = OfflineModule(config, params, filename)
+    shared = module.params
+    facts = dict()
+    errors = dict()
+    for name in names:
+        module_name, required, defaults, extractor = EXTRACTORS[name]
+        module.params = dict(defaults)
+        module.params.update(shared)
+        try:
+            facts[name] = extractor(get_facts_module(name), module)
+        except Exception as exc:
+            errors[name] = '%s: %s' % (type(exc).__name__, exc)
+    return facts, errors
@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Simulates an NX-OS switch for running the modules without a network
+
+The switch serves the NX-API /ins endpoint, both the ins_api and the
+JSON-RPC flavours, and with paramiko installed an SSH CLI. Its running
+config is a CustomNetworkConfig of the facts modules that the config
+commands change, so a module reads back what it pushed.
+
+    python3 tools/simulator.py --config leaf1.cfg --nxapi-port 8080 \\
+        --ssh-port 2222 --latency 0.05 --bandwidth 1000000 --error-rate 0.01
+
+Point the provider of a play at it with transport nxapi and port 8080,
+or transport cli and port 2222. Commands other than the config, show
+running-config, show version, show vrf and checkpoint ones are answered
+from the --responses file, a JSON object of command to body. --reject
+makes the switch reject the commands holding a text, as an older release
+rejects a filter it does not know.
+
+Mode changes in config commands follow a fixed list of the commands
+that enter a sub-mode, see SUBMODE_COMMANDS.
+
+Requires python 3.5.
+"""
+
+import re
+import json
+import time
+import base64
+import random
+import socket
+import asyncio
+import argparse
+import threading
+
+from ansible.module_utils.nxos import NEGATED_LINES, apply_line
+
+from offline import COMMON_MODULE, load_facts_module
+
+# commands entering a config sub-mode off the top level
+TOP_MODE_COMMANDS = ['interface ', 'router ', 'vrf context ', 'evpn', 'vlan ',
+                     'route-map ', 'ip access-list ', 'ipv6 access-list ',
+                     'line ', 'role name ', 'key chain ']
+
+# top level commands that leave whatever sub-mode they are given in
+TOP_COMMANDS = ['feature ', 'hostname ', 'ip route ', 'nv overlay ',
+                'fabric forwarding ', 'ip pim ', 'spanning-tree ']
+
+# commands entering a nested sub-mode, a command leaves the nested modes
+# of the same or a lower rank before entering its own
+SUBMODE_COMMANDS = [('vrf ', 1), ('vni ', 1), ('member vni ', 1),
+                    ('template ', 2), ('neighbor ', 2), ('address-family ', 3)]
+
+MODE_PROMPTS = {'interface': 'if', 'neighbor': 'router-neighbor',
+                'address-family': 'router-af', 'template': 'router-template',
+                'vrf': 'router-vrf', 'vni': 'evpn-evi', 'member': 'if-nve-vni'}
+
+EXEC_PREFIXES = ('show ', 'terminal ', 'copy ', 'checkpoint ', 'no checkpoint ',
+                 'rollback ')
+
+
+class CommandError(Exception):
+    pass
+
+
+def startswith(text, prefixes):
+    for prefix in prefixes:
+        if text.startswith(prefix) or text == prefix.strip():
+            return True
+    return False
+
+
+def submode_rank(text):
+    for prefix, rank in SUBMODE_COMMANDS:
+        if text.startswith(prefix):
+            return rank
+
+
+class Session(object):
+    """The mode a CLI session or a batch of commands is in
+    """
+
+    def __init__(self, configuring=False):
+        self.configuring = configuring
+        self.context = list()
+
+    def prompt(self, hostname):
+        if not self.configuring:
+            return '%s# ' % hostname
+        if not self.context:
+            return '%s(config)# ' % hostname
+        mode = self.context[-1].split()[0]
+        return '%s(config-%s)# ' % (hostname, MODE_PROMPTS.get(mode, mode))
+
+
+class Device(object):
+    """The state of the simulated switch, shared by all its sessions
+    """
+
+    def __init__(self, config='', hostname='switch', responses=None, rejects=None):
+        self.common = load_facts_module(COMMON_MODULE)
+        self.config = self.common.CustomNetworkConfig(indent=2, contents=config)
+        self.responses = responses or dict()
+        self.rejects = rejects or list()
+        self.checkpoints = dict()
+        self.startup_config = self.render()
+        self.lock = threading.Lock()
+
+        match = re.search(r'^hostname (\S+)', config, re.M)
+        self.hostname = match.group(1) if match else hostname
+
+    def render(self, items=None):
+        """Returns the running config, or the sections of items, as text
+        """
+        lines = list()
+
+        def walk(item):
+            lines.append(item.raw)
+            for child in item.children:
+                walk(child)
+
+        for item in (self.config.items if items is None else items):
+            if item.parent is None:
+                walk(item)
+        return '\n'.join(lines) + '\n'
+
+    def execute(self, session, command, output='json'):
+        with self.lock:
+            return self._execute(session, command.strip(), output)
+
+    def _execute(self, session, command, output):
+        if not command:
+            return ''
+        if any(text in command for text in self.rejects):
+            raise CommandError('Invalid command at \'^\' marker.')
+        if command in ('config', 'configure', 'configure terminal', 'config t', 'conf t'):
+            session.configuring = True
+            session.context = list()
+            return ''
+        if command == 'end':
+            session.configuring = False
+            session.context = list()
+            return ''
+        if command == 'exit':
+            if session.context:
+                session.context.pop()
+            else:
+                session.configuring = False
+            return ''
+
+        if command.endswith('| json'):
+            return json.dumps(self._execute(session, command[:-6].strip(), 'json'))
+
+        if command.startswith('checkpoint '):
+            self.checkpoints[command.split()[-1]] = self.render()
+            return ''
+        if command.startswith('no checkpoint '):
+            self.checkpoints.pop(command.split()[-1], None)
+            return ''
+        if command.startswith('rollback running-config checkpoint '):
+            name = command.split()[-1]
+            if name not in self.checkpoints:
+                raise CommandError('Checkpoint %s does not exist' % name)
+            self.config = self.common.CustomNetworkConfig(indent=2,
+                                                          contents=self.checkpoints[name])
+            return ''
+        if command.startswith('copy running-config startup-config'):
+            self.startup_config = self.render()
+            return 'Copy complete.'
+        if command.startswith('terminal '):
+            return ''
+
+        if command.startswith('show '):
+            return self.show(command, output)
+        if session.configuring:
+            self.configure(session, command)
+            return ''
+        raise CommandError('Invalid command at \'^\' marker.')
+
+    def show(self, command, output):
+        if command.startswith('show running-config'):
+            return self.show_running_config(command)
+
+        if command in self.responses:
+            body = self.responses[command]
+        elif command == 'show version':
+            body = dict(host_name=self.hostname, chassis_id='Nexus9000 C9396PX Chassis',
+                        kickstart_ver_str='7.0(3)I5(1)', sys_ver_str='7.0(3)I5(1)')
+        elif command == 'show vrf':
+            names = ['default'] + re.findall(r'^vrf context (\S+)', self.render(), re.M)
+            body = dict(TABLE_vrf=dict(ROW_vrf=[dict(vrf_name=n, vrf_state='Up')
+                                                for n in names]))
+        elif command == 'show hostname':
+            body = dict(hostname=self.hostname)
+        else:
+            raise CommandError('Invalid command at \'^\' marker.')
+
+        if output == 'text' and not isinstance(body, str):
+            return json.dumps(body, indent=2)
+        return body
+
+    def show_running_config(self, command):
+        command, sep, pipe = command.partition('|')
+        # all comes last, after the section filter if there is one
+        words = [w for w in command.split()[2:] if w != 'all']
+
+        items = [item for item in self.config.items if item.parent is None]
+        if words:
+            name = ' '.join(words)
+            prefix = {'bgp': 'router bgp', 'ospf': 'router ospf'}.get(name, name)
+            # the whole header word by word, Ethernet1/1 is not Ethernet1/10
+            items = [i for i in items if i.text == prefix or i.text.startswith(prefix + ' ')
+                     or i.text == 'feature %s' % name]
+        pipe = pipe.strip()
+        if pipe.startswith('section '):
+            regex = re.compile(pipe[8:].strip())
+            items = [i for i in items if regex.search(i.text)]
+        return self.render(items)
+
+    def configure(self, session, command):
+        if startswith(command, TOP_MODE_COMMANDS):
+            session.context = list()
+            self.apply(session.context, command)
+            session.context.append(command)
+        elif startswith(command, TOP_COMMANDS):
+            session.context = list()
+            self.apply(session.context, command)
+        elif session.context and submode_rank(command):
+            rank = submode_rank(command)
+            while len(session.context) > 1 and submode_rank(session.context[-1]) >= rank:
+                session.context.pop()
+            self.apply(session.context, command)
+            session.context.append(command)
+        else:
+            self.apply(session.context, command)
+
+    def apply(self, parents, text):
+        if text.startswith('no '):
+            self.remove(parents, text[3:])
+            if text[3:] in NEGATED_LINES:
+                self.config.add(text, parents=parents)
+            return
+
+        self.remove(parents, 'no %s' % text)
+        if not apply_line(self.config, self._line(parents, text)):
+            raise CommandError('Invalid command at \'^\' marker.')
+
+    def _line(self, parents, text):
+        """Returns a detached ConfigLine for text under the parents path
+        """
+        parent = None
+        for name in parents:
+            line = self.common.ConfigLine(name)
+            line.parent = parent
+            parent = line
+        item = self.common.ConfigLine(text)
+        item.raw = text
+        item.parent = parent
+        return item
+
+    def remove(self, parents, text):
+        """Removes the lines under parents that are text, or text with arguments
+        """
+        if parents:
+            obj = self.config.get_object(parents)
+            candidates = obj.children if obj else ()
+        else:
+            candidates = [i for i in self.config.items if i.parent is None]
+
+        removed = set()
+        for item in list(candidates):
+            if item.text == text or item.text.startswith('%s ' % text):
+                stack = [item]
+                while stack:
+                    line = stack.pop()
+                    removed.add(id(line))
+                    stack.extend(line.children)
+                if item.parent is not None:
+                    item.parent._children.remove(item)
+        if removed:
+            self.config._config = [i for i in self.config.items if id(i) not in removed]
+
+
+class Link(object):
+    """Latency, bandwidth and failures applied to every request
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0, drop_rate=0.0,
+                 seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+
+    def fail(self):
+        return self.random.random() < self.error_rate
+
+    def drop(self):
+        return self.random.random() < self.drop_rate
+
+    def transfer_time(self, size):
+        if not self.bandwidth:
+            return 0.0
+        return float(size) / self.bandwidth
+
+    async def send(self, writer, data, chunk=65536):
+        for start in range(0, len(data), chunk):
+            piece = data[start:start + chunk]
+            writer.write(piece)
+            await writer.drain()
+            await asyncio.sleep(self.transfer_time(len(piece)))
+
+    def send_channel(self, channel, data, chunk=65536):
+        for start in range(0, len(data), chunk):
+            piece = data[start:start + chunk]
+            channel.sendall(piece)
+            time.sleep(self.transfer_time(len(piece)))
+
+
+class NxapiServer(object):
+    """Serves the NX-API /ins endpoint of a Device
+    """
+
+    COMMAND_TYPE_TO_OUTPUT = {
+        'cli_show': 'json',
+        'cli_show_ascii': 'text',
+        'cli_conf': 'config',
+        'bash': 'text'
+    }
+
+    def __init__(self, device, link, username=None, password=None):
+        self.device = device
+        self.link = link
+        self.credentials = None
+        if username:
+            token = base64.b64encode(('%s:%s' % (username, password or '')).encode('utf-8'))
+            self.credentials = 'Basic %s' % token.decode('ascii')
+        self.requests = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                fields = dict()
+                while True:
+                    header = (await reader.readline()).decode('latin-1').strip()
+                    if not header:
+                        break
+                    key, sep, value = header.partition(':')
+                    fields[key.strip().lower()] = value.strip()
+                data = await reader.readexactly(int(fields.get('content-length', 0)))
+
+                self.requests += 1
+                self.request_bytes += len(data)
+                if self.link.drop():
+                    break
+                await asyncio.sleep(self.link.latency)
+
+                status, payload = self.respond(line, fields, data)
+                self.response_bytes += len(payload)
+                head = ['HTTP/1.1 %s' % status,
+                        'Content-Type: application/json',
+                        'Content-Length: %d' % len(payload)]
+                if status.startswith('401'):
+                    # clients such as urllib2 only send credentials when challenged
+                    head.append('WWW-Authenticate: Basic realm="nxapi"')
+                else:
+                    head.append('Set-Cookie: nxapi_auth=simulator; Secure; HttpOnly')
+                await self.link.send(writer, ('\r\n'.join(head) + '\r\n\r\n').encode('ascii') + payload)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # a switch shut down with the connection still open
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, line, fields, data):
+        method, path = line.decode('latin-1').split()[:2]
+        if method != 'POST' or path != '/ins':
+            return '404 Not Found', b'{}'
+        # ansible 2.1 sends back the whole Set-Cookie value, attributes included
+        cookies = [c.strip() for c in fields.get('cookie', '').split(';')]
+        if self.credentials and 'nxapi_auth=simulator' not in cookies \
+                and fields.get('authorization') != self.credentials:
+            return '401 Unauthorized', b'{}'
+        if self.link.fail():
+            return '500 Internal Server Error', b'{}'
+
+        try:
+            request = json.loads(data.decode('utf-8'))
+        except ValueError:
+            return '400 Bad Request', b'{}'
+
+        if 'json-rpc' in fields.get('content-type', ''):
+            response = self.json_rpc(request)
+        else:
+            response = self.ins_api(request['ins_api'])
+        return '200 OK', json.dumps(response).encode('utf-8')
+
+    def ins_api(self, request):
+        output_type = self.COMMAND_TYPE_TO_OUTPUT.get(request['type'], 'json')
+        session = Session(configuring=output_type == 'config')
+        outputs = list()
+        for command in request['input'].split(' ;'):
+            try:
+                body = self.device.execute(session, command, output_type)
+                outputs.append(dict(code='200', msg='Success', input=command, body=body or {}))
+            except CommandError as exc:
+                outputs.append(dict(code='400', msg='Input CLI command error',
+                                    input=command, clierror=str(exc)))
+                # the switch stops at the first failing command
+                break
+        output = outputs[0] if len(outputs) == 1 else outputs
+        return dict(ins_api=dict(type=request['type'], version=request.get('version'),
+                                 sid='eoc', outputs=dict(output=output)))
+
+    def json_rpc(self, request):
+        # the commands of a batch share the session, so a batch can hold
+        # both the mode changes and the config commands
+        session = Session()
+        responses = list()
+        for call in (request if isinstance(request, list) else [request]):
+            command = call['params']['cmd']
+            output = 'text' if call.get('method') == 'cli_ascii' else 'json'
+            try:
+                if not command.startswith(EXEC_PREFIXES) and not session.configuring:
+                    session.configuring = True
+                body = self.device.execute(session, command, output)
+                if output == 'text':
+                    result = dict(msg=body)
+                else:
+                    result = dict(body=body) if body else None
+                responses.append(dict(jsonrpc='2.0', result=result, id=call.get('id')))
+            except CommandError as exc:
+                responses.append(dict(jsonrpc='2.0', id=call.get('id'),
+                                      error=dict(code=-32602, message='Invalid params',
+                                                 data=dict(msg=str(exc)))))
+        return responses if isinstance(request, list) else responses[0]
+
+
+def serve_ssh(device, link, port, username=None, password=None, host_key=None):
+    """Serves the CLI of device over SSH from a thread, requires paramiko
+    """
+    import paramiko
+
+    key = paramiko.RSAKey(filename=host_key) if host_key else paramiko.RSAKey.generate(2048)
+
+    class Server(paramiko.ServerInterface):
+
+        def check_auth_password(self, user, secret):
+            if username is None or (user, secret) == (username, password):
+                return paramiko.AUTH_SUCCESSFUL
+            return paramiko.AUTH_FAILED
+
+        def get_allowed_auths(self, user):
+            return 'password'
+
+        def check_channel_request(self, kind, chanid):
+            if kind == 'session':
+                return paramiko.OPEN_SUCCEEDED
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+        def check_channel_pty_request(self, *args):
+            return True
+
+        def check_channel_shell_request(self, channel):
+            return True
+
+    def shell(channel):
+        session = Session()
+        channel.sendall(('\r\n%s' % session.prompt(device.hostname)).encode('utf-8'))
+        pending = b''
+        while True:
+            data = channel.recv(4096)
+            if not data:
+                return
+            pending += data
+            while b'\r' in pending or b'\n' in pending:
+                line, pending = re.split(b'\r\n|\r|\n', pending, 1)
+                command = line.decode('utf-8').strip()
+                if link.drop():
+                    channel.close()
+                    return
+                time.sleep(link.latency)
+                if link.fail():
+                    response = '% Internal error'
+                else:
+                    try:
+                        response = device.execute(session, command, 'text')
+                    except CommandError as exc:
+                        response = '%% %s' % exc
+                # echo the command like a terminal does, then its output
+                lines = [command]
+                if response:
+                    lines.extend(response.rstrip('\n').split('\n'))
+                lines.append(session.prompt(device.hostname))
+                link.send_channel(channel, '\r\n'.join(lines).encode('utf-8'))
+
+    def connection(sock):
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(key)
+        try:
+            transport.start_server(server=Server())
+            channel = transport.accept(30)
+            if channel is not None:
+                shell(channel)
+        except (paramiko.SSHException, socket.error, EOFError):
+            pass
+        finally:
+            transport.close()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(100)
+
+    def accept():
+        while True:
+            sock, addr = listener.accept()
+            threading.Thread(target=connection, args=(sock,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--config', help='initial running config')
+    parser.add_argument('--responses', help='JSON object of command to body')
+    parser.add_argument('--reject', action='append',
+                        help='text of the commands to reject, such as "| section"')
+    parser.add_argument('--nxapi-port', type=int, default=8080)
+    parser.add_argument('--ssh-port', type=int, help='serve the CLI, needs paramiko')
+    parser.add_argument('--host-key', help='SSH host key, a new one by default')
+    parser.add_argument('--username')
+    parser.add_argument('--password')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=float,
+                        help='bytes per second of the responses, unlimited by default')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of requests answered with an error')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='share of requests whose connection is closed')
+    parser.add_argument('--seed', type=int, help='seed of the failure injection')
+    args = parser.parse_args()
+
+    config = ''
+    if args.config:
+        with open(args.config) as f:
+            config = f.read()
+    responses = None
+    if args.responses:
+        with open(args.responses) as f:
+            responses = json.load(f)
+
+    device = Device(config, responses=responses, rejects=args.reject)
+    link = Link(args.latency, args.bandwidth, args.error_rate, args.drop_rate, args.seed)
+
+    if args.ssh_port is not None:
+        port = serve_ssh(device, link, args.ssh_port, args.username, args.password,
+                         args.host_key)
+        print('ssh listening on 127.0.0.1:%d' % port)
+
+    loop = asyncio.get_event_loop()
+    nxapi = NxapiServer(device, link, args.username, args.password)
+    server = loop.run_until_complete(
+        asyncio.start_server(nxapi.handle, '127.0.0.1', args.nxapi_port))
+    print('nxapi listening on 127.0.0.1:%d' % server.sockets[0].getsockname()[1])
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
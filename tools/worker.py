@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Serves the NX-OS facts extractors from a long-lived process
+
+A module run starts an interpreter, imports the facts module and
+compiles its regexes before it gets to the config. The worker does that
+once and then answers requests over a unix socket, one JSON object per
+line each way, as many as a connection sends:
+
+    {"facts": ["bgp"], "params": {"asn": "65535"}, "config": "..."}
+    {"facts": {"bgp": {...}}, "errors": {}, "seconds": 0.012}
+
+config_file can be sent instead of config, for a file the worker can
+read. A request it cannot run gets {"error": "..."} back.
+
+    python tools/worker.py serve
+    python tools/worker.py query --facts bgp --param asn=65535 running-config.txt
+
+The socket is kept under ANSIBLE_NXOS_STATE_DIR by default. Its directory
+has to be owned by the user and closed to everyone else, as anyone
+able to connect can have the worker read files, it is created so when
+missing.
+
+Each connection is handled by a thread of its own, up to
+--max-connections at once, further ones wait to be accepted. A
+connection idle for IDLE_TIMEOUT seconds is closed, so that clients
+left open do not hold on to the threads. The extractors keep no state
+between runs.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from offline import EXTRACTORS, get_facts_module, missing_params, run_extractors
+from audit import parse_param
+
+STATE_DIR = os.environ.get('ANSIBLE_NXOS_STATE_DIR',
+                           os.path.expanduser('~/.ansible/nxos'))
+SOCKET = os.path.join(STATE_DIR, 'worker', 'facts.sock')
+
+MAX_CONNECTIONS = 16
+IDLE_TIMEOUT = 300
+
+
+class WorkerError(Exception):
+    pass
+
+
+def check_socket_dir(path, create=False):
+    """Checks that the directory of the socket path is private to the user
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    if create and not os.path.isdir(dirname):
+        os.makedirs(dirname, 0o700)
+    st = os.stat(dirname)
+    if st.st_uid != os.getuid():
+        raise WorkerError('%s is not owned by the user' % dirname)
+    if st.st_mode & 0o077:
+        raise WorkerError('%s is open to other users, its mode has to be 0700' % dirname)
+
+
+def handle_request(request):
+    """Runs the extractors of request and returns the response
+    """
+    names = request.get('facts') or sorted(EXTRACTORS)
+    params = request.get('params') or dict()
+
+    unknown = [n for n in names if n not in EXTRACTORS]
+    if unknown:
+        return dict(error='unknown facts: %s' % ', '.join(unknown))
+    missing = missing_params(names, params)
+    if missing:
+        return dict(error='missing parameters: %s' % ', '.join(missing))
+
+    config = request.get('config')
+    filename = None
+    if config is None:
+        filename = request.get('config_file')
+        if not filename:
+            return dict(error='one of config or config_file is required')
+
+    start = time.time()
+    try:
+        facts, errors = run_extractors(config, names, params, filename)
+    except (IOError, OSError) as exc:
+        return dict(error=str(exc))
+    return dict(facts=facts, errors=errors, seconds=round(time.time() - start, 6))
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    timeout = IDLE_TIMEOUT
+
+    def handle(self):
+        while True:
+            try:
+                line = self.rfile.readline()
+            except socket.timeout:
+                break
+            if not line:
+                break
+            try:
+                response = handle_request(json.loads(line.decode('utf-8')))
+            except ValueError as exc:
+                response = dict(error='invalid request: %s' % exc)
+            except Exception as exc:
+                response = dict(error='%s: %s' % (type(exc).__name__, exc))
+            self.wfile.write(('%s\n' % json.dumps(response)).encode('utf-8'))
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, handler, max_connections=MAX_CONNECTIONS):
+        socketserver.UnixStreamServer.__init__(self, path, handler)
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        # a connection over the limit waits here, before a thread is started
+        self.slots.acquire()
+        try:
+            socketserver.ThreadingMixIn.process_request(self, request, client_address)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            socketserver.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.slots.release()
+
+
+def warm_up():
+    """Loads every facts module, returns the errors of those that failed
+    """
+    errors = dict()
+    for name in sorted(EXTRACTORS):
+        try:
+            get_facts_module(name)
+        except Exception as exc:
+            errors[name] = '%s: %s' % (type(exc).__name__, exc)
+    return errors
+
+
+def serve(path, max_connections=MAX_CONNECTIONS):
+    check_socket_dir(path, create=True)
+    # modules are loaded ahead, the handler threads only read them
+    for name, error in sorted(warm_up().items()):
+        sys.stderr.write('%s is not available, %s\n' % (name, error))
+
+    if os.path.exists(path):
+        os.remove(path)
+    umask = os.umask(0o177)
+    try:
+        server = Server(path, RequestHandler, max_connections)
+    finally:
+        os.umask(umask)
+    sys.stderr.write('serving on %s\n' % path)
+    # stopped by a TERM as by an interrupt, removing the socket
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+class Client(object):
+    """A connection to a worker, requests are sent one at a time
+    """
+
+    def __init__(self, path=SOCKET):
+        # a socket in a directory others can write to may not be the worker's
+        check_socket_dir(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+
+    def request(self, names=None, params=None, config=None, config_file=None):
+        request = dict(facts=names, params=params or dict())
+        if config_file:
+            request['config_file'] = os.path.abspath(config_file)
+        else:
+            request['config'] = config
+        self.sock.sendall(('%s\n' % json.dumps(request)).encode('utf-8'))
+        line = self.rfile.readline()
+        if not line:
+            raise IOError('connection closed by the worker')
+        return json.loads(line.decode('utf-8'))
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+def query_worker(args):
+    client = Client(args.socket)
+    try:
+        response = client.request(args.facts, dict(args.param), config_file=args.file)
+    finally:
+        client.close()
+    print(json.dumps(response, indent=2, sort_keys=True))
+    if 'error' in response:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--socket', default=SOCKET, help='unix socket of the worker')
+    commands = parser.add_subparsers(dest='command')
+    serve_parser = commands.add_parser('serve', help='run the worker')
+    serve_parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                              help='connections handled at once')
+    query = commands.add_parser('query', help='send a request to the worker')
+    query.add_argument('file', help='saved running config')
+    query.add_argument('--facts', action='append', choices=sorted(EXTRACTORS),
+                       help='extractors to run, all by default')
+    query.add_argument('--param', action='append', type=parse_param, default=[],
+                       help='extractor parameter as key=value')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'serve':
+            serve(args.socket, args.max_connections)
+        elif args.command == 'query':
+            query_worker(args)
+        else:
+            parser.error('a command is required')
+    except WorkerError as exc:
+        parser.exit(1, 'error: %s\n' % exc)
+
+
+if __name__ == '__main__':
+    main()